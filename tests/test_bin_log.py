@@ -1,13 +1,17 @@
+import itertools
 import os
 import struct
 import time
 import unittest
 
-from timyd.logged_properties import BinaryLog, InvalidFile
+from timyd.logged_properties import BinaryLog, InvalidFile, LockedFile, \
+    bin_log
 
 
 class Test_read_bin_log(unittest.TestCase):
     FILE = 'tests/run_read.binlog'
+    USE_MMAP = True
+    LAZY = False
     # 1 'name': 'remram'
     # 2 'age': 21
     # 3 'age': 22
@@ -108,7 +112,8 @@ class Test_read_bin_log(unittest.TestCase):
     def test_read_props(self):
         """Reads the last value of properties.
         """
-        with BinaryLog(self.FILE, readonly=True, debug=True) as log:
+        with BinaryLog(self.FILE, readonly=True, debug=True,
+                       use_mmap=self.USE_MMAP, lazy=self.LAZY) as log:
             self.assertEqual(log.get_property('name'), (4, 'remi'))
             self.assertEqual(log.get_property('age'), (5, 23))
 
@@ -118,7 +123,8 @@ class Test_read_bin_log(unittest.TestCase):
     def test_iter_props(self):
         """Reads the history of properties.
         """
-        with BinaryLog(self.FILE, readonly=True, debug=True) as log:
+        with BinaryLog(self.FILE, readonly=True, debug=True,
+                       use_mmap=self.USE_MMAP, lazy=self.LAZY) as log:
             for search in (1, -1):
                 ages = log.get_property_history('age', 3, dir=1,
                                                 search=search)
@@ -148,8 +154,54 @@ class Test_read_bin_log(unittest.TestCase):
                 self.assertRaises(StopIteration, names.next)
 
 
+    def test_invalid_length(self):
+        """Reads a string running past the end of the file.
+        """
+        with open(self.FILE, 'r+b') as fp:
+            fp.seek(162) # length of 'remi'
+            fp.write(struct.pack('>H', 0x4000))
+        with BinaryLog(self.FILE, readonly=True,
+                       use_mmap=self.USE_MMAP, lazy=self.LAZY) as log:
+            self.assertRaises(InvalidFile, log.get_property, 'name')
+            self.assertEqual(log.get_property('age'), (5, 23))
+
+
+    def test_append(self):
+        """Appends to a BINLOG01 log.
+        """
+        with BinaryLog(self.FILE) as log:
+            self.assertEqual(log.version, 1)
+            log.set_property('age', 24, t=6)
+            log.set_property('city', "Paris", t=6)
+        with BinaryLog(self.FILE, readonly=True,
+                       use_mmap=self.USE_MMAP, lazy=self.LAZY) as log:
+            self.assertEqual(log.get_property('city'), (6, "Paris"))
+            self.assertEqual(list(log.get_property_history('age', 4)),
+                             [(5, 23), (6, 24)])
+
+    def test_writer(self):
+        """Reads a BINLOG01 log while a writer drops its summary.
+        """
+        with BinaryLog(self.FILE, readonly=True,
+                       use_mmap=self.USE_MMAP, lazy=self.LAZY) as reader:
+            with BinaryLog(self.FILE) as writer:
+                writer.set_property('age', 24, t=6)
+                writer.set_property('city', "Paris", t=6)
+                self.assertEqual(reader.get_property('age'), (5, 23))
+                self.assertEqual(reader.get_property('name'), (4, "remi"))
+
+
+class Test_read_bin_log_nommap(Test_read_bin_log):
+    USE_MMAP = False
+
+
+class Test_read_bin_log_lazy(Test_read_bin_log):
+    LAZY = True
+
+
 class Test_write_bin_log(unittest.TestCase):
     FILE = 'tests/run_write.binlog'
+    VERSION = 2
 
     def setUp(self):
         if os.path.exists(self.FILE):
@@ -158,12 +210,363 @@ class Test_write_bin_log(unittest.TestCase):
     def test_simple(self):
         """Writes some properties and read them back.
         """
-        with BinaryLog(self.FILE, debug=True) as log:
+        with BinaryLog(self.FILE, debug=True, version=self.VERSION) as log:
             log.set_property('name', "remi")
             self.assertRaises(KeyError, log.get_property, 'age')
             log['age'] = 20
             self.assertEqual(log.get_property('name')[1], "remi")
-        with BinaryLog(self.FILE, debug=True) as log:
+        with BinaryLog(self.FILE, debug=True, version=self.VERSION) as log:
             log.set_property('age', 21)
             self.assertEqual(log.get_property('name')[1], "remi")
             self.assertEqual(log.get_property('age')[1], 21)
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_batch(self):
+        """Gathers changes in a batch, reading them back before they're written.
+        """
+        with BinaryLog(self.FILE, debug=True, version=self.VERSION) as log:
+            log['name'] = "remram"
+            log.set_property('age', 21, t=1)
+        size = os.path.getsize(self.FILE)
+        with BinaryLog(self.FILE, debug=True, version=self.VERSION) as log:
+            with log.batch():
+                log.set_property('age', 22, t=2)
+                log.set_property('name', "remi", t=3)
+                with log.batch():
+                    log.set_property('age', 23, t=4)
+                self.assertEqual(os.path.getsize(self.FILE), size)
+                self.assertEqual(log['name'], "remi")
+                self.assertEqual(list(log.get_property_history('age')),
+                                 [(1, 21), (2, 22), (4, 23)])
+                self.assertEqual(list(log.get_property_history('age',
+                                                               dir=-1)),
+                                 [(4, 23), (2, 22), (1, 21)])
+            log._file.flush()
+            self.assertNotEqual(os.path.getsize(self.FILE), size)
+            self.assertEqual(log['age'], 23)
+        with BinaryLog(self.FILE, readonly=True) as log:
+            self.assertEqual(list(log.get_property_history('age')),
+                             [(1, 21), (2, 22), (4, 23)])
+            self.assertEqual(list(log.get_property_history('age', 2)),
+                             [(2, 22), (4, 23)])
+            self.assertEqual(log.get_property('name'), (3, "remi"))
+
+    def test_many_properties(self):
+        """Writes enough properties to need several table pages.
+        """
+        names = ['property_number_%04d' % i for i in xrange(500)]
+        with BinaryLog(self.FILE, version=self.VERSION) as log:
+            for i, name in enumerate(names):
+                log.set_property(name, i, t=1)
+        with BinaryLog(self.FILE, version=self.VERSION) as log:
+            log.set_property(names[42], 'changed', t=2)
+        size = os.path.getsize(self.FILE)
+        with BinaryLog(self.FILE, readonly=True) as log:
+            self.assertEqual(log.version, self.VERSION)
+            for i, name in enumerate(names):
+                if i != 42:
+                    self.assertEqual(log.get_property(name), (1, i))
+            self.assertEqual(list(log.get_property_history(names[42])),
+                             [(1, 42), (2, 'changed')])
+            if self.VERSION == 2:
+                self.assertTrue(len(log._pages) > 1)
+        for use_mmap in (False, True):
+            with BinaryLog(self.FILE, readonly=True, use_mmap=use_mmap,
+                           lazy=True) as log:
+                self.assertEqual(log.get_property(names[3]), (1, 3))
+                if self.VERSION == 2:
+                    # Only the entries up to the one asked for are parsed
+                    self.assertEqual(len(log._property_updates), 4)
+                self.assertEqual(log.get_property(names[499]), (1, 499))
+                self.assertEqual(list(log.get_property_history(names[42])),
+                                 [(1, 42), (2, 'changed')])
+                self.assertRaises(KeyError, log.get_property, 'missing')
+                self.assertEqual(len(log._property_updates), 500)
+        self.assertRaises(ValueError, BinaryLog, self.FILE, lazy=True)
+        with BinaryLog(self.FILE, version=self.VERSION) as log:
+            pass
+        self.assertEqual(os.path.getsize(self.FILE), size)
+
+
+class Test_write_bin_log_v1(Test_write_bin_log):
+    VERSION = 1
+
+
+class Test_bin_log_v2(unittest.TestCase):
+    FILE = 'tests/run_v2.binlog'
+
+    def setUp(self):
+        if os.path.exists(self.FILE):
+            os.remove(self.FILE)
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_incremental_close(self):
+        """Closing only writes the record and the entry that changed.
+        """
+        with BinaryLog(self.FILE) as log:
+            for i in xrange(200):
+                log.set_property('prop%d' % i, i, t=1)
+        size = os.path.getsize(self.FILE)
+        with BinaryLog(self.FILE) as log:
+            log.set_property('prop7', 8, t=2)
+        # A single record, no summary: 26 + len('prop7') + 9
+        self.assertEqual(os.path.getsize(self.FILE), size + 40)
+        with BinaryLog(self.FILE, readonly=True) as log:
+            self.assertEqual(log['prop7'], 8)
+            self.assertEqual(log['prop199'], 199)
+
+    def test_invalid_table(self):
+        with BinaryLog(self.FILE) as log:
+            log['name'] = "remi"
+        with open(self.FILE, 'r+b') as fp:
+            fp.seek(24)
+            fp.write('NOTATABL')
+        self.assertRaises(InvalidFile, BinaryLog, self.FILE)
+
+    def test_property_ids(self):
+        """Writes records with property IDs instead of names.
+        """
+        names = ['a_rather_long_property_name_%d' % i for i in xrange(10)]
+        for ids in (False, True):
+            self.setUp()
+            with BinaryLog(self.FILE, property_ids=ids) as log:
+                for t in xrange(20):
+                    for i, name in enumerate(names):
+                        log.set_property(name, t * i, t=t)
+            if not ids:
+                size = os.path.getsize(self.FILE)
+        # Each record is shorter by the length of the name
+        self.assertEqual(os.path.getsize(self.FILE),
+                         size - 200 * len(names[0]))
+        with BinaryLog(self.FILE) as log:
+            log.set_property('new', "value", t=20)
+            log.set_property(names[3], 0, t=20)
+        for use_mmap in (False, True):
+            with BinaryLog(self.FILE, readonly=True,
+                           use_mmap=use_mmap) as log:
+                self.assertEqual(log.get_property('new'), (20, "value"))
+                self.assertEqual(log._read_property_change_at(
+                                         log._property_updates['new'][1])[3],
+                                 'new')
+                history = list(log.get_property_history(names[3], 17))
+                self.assertEqual(history, [(17, 51), (18, 54), (19, 57),
+                                           (20, 0)])
+        self.assertRaises(ValueError, BinaryLog, self.FILE + '1',
+                          version=1, property_ids=True)
+
+
+class Test_bin_log_index(unittest.TestCase):
+    FILE = 'tests/run_index.binlog'
+
+    def setUp(self):
+        for f in (self.FILE, self.FILE + '.idx'):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_range_queries(self):
+        """Finds the start of a range through the index.
+        """
+        with BinaryLog(self.FILE, index_interval=16) as log:
+            for i in xrange(500):
+                log.set_property('up', i % 3, t=i * 2)
+                if i % 7 == 0:
+                    log.set_property('other', i, t=i * 2)
+        # Later runs update the index
+        with BinaryLog(self.FILE) as log:
+            self.assertEqual(log._index_interval, 16)
+            log.set_property('up', 42, t=1000)
+
+        def query(log):
+            results = []
+            for start in (-1, 0, 1, 2, 301, 500, 998, 999, 1000, 2000):
+                for dir in (1, -1):
+                    for search in (1, -1):
+                        it = log.get_property_history('up', start,
+                                                      dir=dir, search=search)
+                        results.append(list(itertools.islice(it, 3)))
+            return results
+
+        with BinaryLog(self.FILE, readonly=True) as log:
+            self.assertEqual(log._index['up'][0], 501)
+            self.assertEqual(len(log._index['up'][1]), 32)
+            indexed = query(log)
+        os.remove(self.FILE + '.idx')
+        with BinaryLog(self.FILE, readonly=True) as log:
+            self.assertEqual(log._index, {})
+            self.assertEqual(query(log), indexed)
+        self.assertEqual(indexed[0], [(0, 0), (2, 1), (4, 2)])
+
+
+class Test_bin_log_journal(unittest.TestCase):
+    FILE = 'tests/run_journal.binlog'
+
+    def setUp(self):
+        for f in (self.FILE, self.FILE + '.wal'):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def tearDown(self):
+        self.setUp()
+
+    def crash(self, log):
+        """Drops a log without flushing it, as if the process was killed.
+        """
+        bin_log._opened_logs.discard(log)
+        log._file.close()
+        if log._journal_file is not None:
+            log._journal_file.close()
+
+    def check(self, history):
+        with BinaryLog(self.FILE, readonly=True) as log:
+            for prop, values in history.iteritems():
+                self.assertEqual(list(log.get_property_history(prop)),
+                                 values)
+                self.assertEqual(list(log.get_property_history(prop,
+                                                               dir=-1)),
+                                 values[::-1])
+
+    def test_replay(self):
+        """Writes the batches again from the journal after a crash.
+        """
+        for version, ids in ((1, False), (2, False), (2, True)):
+            self.setUp()
+            with BinaryLog(self.FILE, version=version, property_ids=ids,
+                           journal=True) as log:
+                log.set_property('status', '', t=1)
+            self.assertFalse(os.path.exists(self.FILE + '.wal'))
+            log = BinaryLog(self.FILE, journal=True)
+            with log.batch():
+                log.set_property('status', 'CantConnect', t=2)
+                log.set_property('banner', 'SSH-2.0', t=2)
+            size = os.path.getsize(self.FILE)
+            with log.batch():
+                log.set_property('status', '', t=3)
+                log.set_property('latency', 12, t=3)
+            self.assertTrue(os.path.exists(self.FILE + '.wal'))
+            self.crash(log)
+            # The last batch was only partly written
+            with open(self.FILE, 'r+b') as fp:
+                fp.truncate(size + 10)
+
+            with BinaryLog(self.FILE, journal=True) as log:
+                self.assertEqual(log.get_property('latency'), (3, 12))
+                self.assertFalse(os.path.exists(self.FILE + '.wal'))
+                log.set_property('status', 'TimedOut', t=4)
+            self.check({'status': [(1, ''), (2, 'CantConnect'), (3, ''),
+                                   (4, 'TimedOut')],
+                        'banner': [(2, 'SSH-2.0')],
+                        'latency': [(3, 12)]})
+
+    def test_recover(self):
+        """Rebuilds the summary from the records, without a journal.
+        """
+        for version in (1, 2):
+            self.setUp()
+            with BinaryLog(self.FILE, version=version) as log:
+                for t in xrange(10):
+                    log.set_property('status', str(t % 2), t=t)
+                    log.set_property('count', t, t=t)
+            log = BinaryLog(self.FILE)
+            log.set_property('status', 'new', t=10)
+            size = log._size
+            log.set_property('count', 10, t=10)
+            self.crash(log)
+            with open(self.FILE, 'r+b') as fp:
+                fp.truncate(size + 20)
+                if version == 2:
+                    # Table pointing nowhere
+                    fp.seek(16)
+                    fp.write(struct.pack('>q', size * 2))
+            self.assertRaises(InvalidFile, BinaryLog, self.FILE)
+
+            with BinaryLog(self.FILE, journal=True) as log:
+                self.assertEqual(log.get_property('count'), (9, 9))
+                log.set_property('count', 11, t=11)
+            # Cut after the last whole record; BINLOG01 has a summary after
+            # the new record
+            summary = 16 + 24 + 23 if version == 1 else 0
+            self.assertEqual(os.path.getsize(self.FILE),
+                             size + 26 + 5 + 9 + summary)
+            self.check({'status': [(t, str(t % 2)) for t in xrange(10)] +
+                                  [(10, 'new')],
+                        'count': [(t, t) for t in xrange(10)] + [(11, 11)]})
+
+
+class Test_bin_log_compact(unittest.TestCase):
+    FILE = 'tests/run_compact.binlog'
+
+    def setUp(self):
+        for f in (self.FILE, self.FILE + '.idx', self.FILE + '.compact'):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def tearDown(self):
+        self.setUp()
+
+    def write(self, **options):
+        self.setUp()
+        with BinaryLog(self.FILE, **options) as log:
+            for i in xrange(100):
+                with log.batch():
+                    log.set_property('status',
+                                     'TimedOut' if i in (10, 11) else '',
+                                     t=i * 600)
+                    log.set_property('latency', i, t=i * 600)
+
+    def check(self, status, latency):
+        with BinaryLog(self.FILE, readonly=True) as log:
+            recent = [i * 600 for i in xrange(89, 100)]
+            self.assertEqual(list(log.get_property_history('status')),
+                             status + [(t, '') for t in recent])
+            self.assertEqual(list(log.get_property_history('latency')),
+                             latency + [(t, t // 600) for t in recent])
+            self.assertEqual(log.get_property('status'), (59400, ''))
+            return log._index_interval
+
+    def test_transitions(self):
+        """Keeps the old changes that change the value.
+        """
+        for version, options in ((1, {}),
+                                 (2, {'property_ids': True,
+                                      'index_interval': 10})):
+            self.write(version=version, **options)
+            with BinaryLog(self.FILE) as log:
+                self.assertEqual(log.compact(6000, t=59400), (200, 114))
+            self.assertFalse(os.path.exists(self.FILE + '.compact'))
+            interval = self.check(
+                    [(0, ''), (6000, 'TimedOut'), (7200, '')],
+                    [(t * 600, t) for t in xrange(89)])
+            self.assertEqual(interval, options.get('index_interval'))
+            self.assertEqual(os.path.exists(self.FILE + '.idx'),
+                             interval is not None)
+
+    def test_resolution(self):
+        """Keeps only the last old change in each interval.
+        """
+        self.write(index_interval=10)
+        with BinaryLog(self.FILE) as log:
+            self.assertEqual(log.compact(6000, 3600, t=59400), (200, 40))
+        self.check([(3000, ''), (6600, 'TimedOut'), (10200, '')],
+                   [(i * 600, i) for i in range(5, 89, 6) + [88]])
+
+    def test_locked(self):
+        """Doesn't compact a log that is being written.
+        """
+        self.write()
+        with BinaryLog(self.FILE, journal=True) as writer:
+            writer.set_property('status', 'CantConnect', t=60000)
+            self.assertTrue(os.path.exists(self.FILE + '.wal'))
+            self.assertRaises(LockedFile, BinaryLog, self.FILE, journal=True)
+            # Readers don't lock
+            with BinaryLog(self.FILE, readonly=True):
+                pass
+        self.assertFalse(os.path.exists(self.FILE + '.wal'))
+        with BinaryLog(self.FILE) as log:
+            self.assertEqual(log.compact(6000, t=59400), (201, 115))
@@ -0,0 +1,82 @@
+import threading
+import time
+import unittest
+
+from timyd import Action, Service, SiteManager, _Site
+
+
+class SlowAction(Action):
+    def __init__(self, delay):
+        self.delay = delay
+        self.events = []
+        self.events_at_end = None
+        self.threads = set()
+
+    def register_status_change(self, site, service, old_status, new_status):
+        time.sleep(self.delay)
+        self.threads.add(threading.current_thread())
+        self.events.append((service, new_status))
+
+    def end_run(self):
+        self.events_at_end = len(self.events)
+
+
+class Test_dispatch(unittest.TestCase):
+    def setUp(self):
+        self._event_queue = SiteManager.event_queue
+
+    def tearDown(self):
+        SiteManager.event_queue = self._event_queue
+
+    def make_site(self):
+        site = _Site('test')
+        for name in ('a', 'b'):
+            site.add_check(Service(name))
+        action = SlowAction(0.01)
+        site.add_action(action)
+        return site, action
+
+    def test_queue(self):
+        """Delivers the events in order from another thread.
+        """
+        SiteManager.event_queue = 4
+        site, action = self.make_site()
+        for i in xrange(20):
+            for name in ('a', 'b'):
+                site.status_changed(site.services[name], None, str(i))
+        self.assertTrue(len(action.events) < 40)
+        site.end_run()
+        self.assertEqual(action.events_at_end, 40)
+        for name in ('a', 'b'):
+            self.assertEqual([status for service, status in action.events
+                              if service == name],
+                             [str(i) for i in xrange(20)])
+        self.assertFalse(threading.current_thread() in action.threads)
+        stats = site.event_stats()
+        self.assertEqual((stats['queued'], stats['delivered'],
+                          stats['depth']),
+                         (40, 40, 0))
+        self.assertTrue(stats['blocked'] > 0)
+        self.assertTrue(stats['max_depth'] <= 4)
+
+    def test_direct(self):
+        SiteManager.event_queue = 0
+        site, action = self.make_site()
+        site.status_changed(site.services['a'], None, 'CantConnect')
+        self.assertEqual(action.events, [('a', 'CantConnect')])
+        self.assertEqual(action.threads, set([threading.current_thread()]))
+        self.assertEqual(site.event_stats(), None)
+
+    def test_stop(self):
+        """Stops the thread after the queued events, restarting it if needed.
+        """
+        SiteManager.event_queue = 4
+        site, action = self.make_site()
+        site.status_changed(site.services['a'], None, '1')
+        site._events.stop()
+        self.assertEqual(action.events, [('a', '1')])
+        self.assertFalse(any(thread.is_alive() for thread in action.threads))
+        site.status_changed(site.services['a'], '1', '2')
+        site.end_run()
+        self.assertEqual(action.events, [('a', '1'), ('a', '2')])
+        self.assertEqual(len(action.threads), 2)
@@ -3,7 +3,8 @@ import time
 import unittest
 
 
-from timyd.checks.server.server import LineReader, InvalidLine, TimedOut
+from timyd.checks.server.server import LineReader, InvalidLine, TimedOut, \
+    InvalidResponse
 
 
 class FakeSocket(object):
@@ -26,6 +27,11 @@ class FakeSocket(object):
         except IndexError:
             raise socket.error
 
+    def recv_into(self, buf, nbytes=0):
+        data = self.recv(nbytes or len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
 
 class Test_linereader(unittest.TestCase):
     def test_simple(self):
@@ -50,3 +56,52 @@ class Test_linereader(unittest.TestCase):
         r = LineReader(s)
 
         self.assertRaises(TimedOut, r.read_line, 100)
+
+    def test_split(self):
+        s = FakeSocket(2, ["a" * 50] * 10 + ["\r\n\nb" * 3, ""])
+        r = LineReader(s)
+
+        self.assertEqual(r.read_line(512), "a" * 500)
+        self.assertEqual(r.read_line(512), "")
+        self.assertEqual(r.read_line(512), "b")
+        self.assertEqual(r.read_line(512), "")
+        self.assertEqual(r.read_line(512), "b")
+        self.assertEqual(r.read_line(512), "")
+        # Connection closed: returns what was left
+        self.assertEqual(r.read_line(512), "b")
+
+    def test_limit(self):
+        s = FakeSocket(2, ["0123456789" * 50, "01\n",
+                           "0123456789" * 50, "0123\n"])
+        r = LineReader(s)
+
+        self.assertEqual(r.read_line(504), "0123456789" * 50 + "01")
+        self.assertRaises(InvalidLine, r.read_line, 504)
+
+    def test_responses(self):
+        s = FakeSocket(2, ["220 mail.example.org ESMTP\r\n250-mail.exa",
+                           "mple.org\r\n250-PIPELINING\r\n250 8BITMIME\r\n",
+                           "150-First\r\n  free-form\r\n150 Done\r\n",
+                           "221 Bye\r\n500-Unfinished", ""])
+        r = LineReader(s)
+
+        self.assertEqual(r.read_response(),
+                         (220, ["mail.example.org ESMTP"]))
+        self.assertEqual(r.read_responses(3), [
+                (250, ["mail.example.org", "PIPELINING", "8BITMIME"]),
+                (150, ["First", "  free-form", "Done"]),
+                (221, ["Bye"])])
+        self.assertRaises(InvalidResponse, r.read_response)
+
+    def test_invalid_response(self):
+        s = FakeSocket(2, ["SSH-2.0-OpenSSH\r\n"])
+        r = LineReader(s)
+
+        self.assertRaises(InvalidResponse, r.read_response)
+
+    def test_long_response(self):
+        s = FakeSocket(2, ["250-a\r\n250-b\r\n250-c\r\n221 Bye\r\n"])
+        r = LineReader(s)
+
+        self.assertRaises(InvalidResponse, r.read_response, max_lines=2)
+        self.assertEqual(r.read_response(), (221, ["Bye"]))
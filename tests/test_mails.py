@@ -0,0 +1,114 @@
+import asyncore
+import smtpd
+import threading
+import time
+import unittest
+
+from timyd.actions.mails import MailAlertAction, MailQueue
+
+
+class SMTPServer(smtpd.SMTPServer):
+    """Local SMTP server keeping the messages it receives.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self._thread = threading.Thread(target=asyncore.loop,
+                                        kwargs={'timeout': 0.1})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+    def stop(self):
+        self.close()
+        self._thread.join()
+
+
+class Test_mails(unittest.TestCase):
+    def setUp(self):
+        self.server = SMTPServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_digest(self):
+        """Merges the alerts of a run, sent in the background.
+        """
+        queue = MailQueue()
+        options = dict(smtp_host='127.0.0.1', smtp_port=self.server.port)
+        admins = MailAlertAction(['admin@example.org'], **options)
+        admins._queue = queue
+        oncall = MailAlertAction('oncall@example.org', **options)
+        oncall._queue = queue
+        start = time.time()
+        for i in xrange(300):
+            admins.register_status_change('site', 'service%d' % i,
+                                          '', 'CantConnect')
+        oncall.register_status_change('site', 'service0', '', 'CantConnect')
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(self.server.messages, [])
+
+        admins.end_run()
+        oncall.end_run()
+        queue.stop(10)
+        self.assertEqual(self.server.connections, 1)
+        messages = sorted(self.server.messages)
+        self.assertEqual([to for to, data in messages],
+                         [['admin@example.org'], ['oncall@example.org']])
+        self.assertTrue('Subject: [timyd] 300 alerts' in messages[0][1])
+        self.assertEqual(messages[0][1].count('Service: service'), 300)
+        self.assertTrue('Subject: [timyd] [site] Service service0 is ' in
+                        messages[1][1])
+
+    def test_max_delay(self):
+        queue = MailQueue(keepalive=0.2)
+        options = dict(smtp_host='127.0.0.1', smtp_port=self.server.port,
+                       max_delay=0.2)
+        queue.put('admin@example.org', 'first', 'body', **options)
+        time.sleep(0.6)
+        self.assertEqual(len(self.server.messages), 1)
+        queue.put('admin@example.org', 'second', 'body', **options)
+        queue.stop(10)
+        self.assertEqual(len(self.server.messages), 2)
+        # The connection was closed after keepalive
+        self.assertEqual(self.server.connections, 2)
+
+    def test_errors(self):
+        """Mails that can't be sent don't stop the others.
+        """
+        queue = MailQueue()
+        queue.put('admin@example.org', 'no server', 'body')
+        queue.put('admin@example.org', 'sent', 'body',
+                  smtp_host='127.0.0.1', smtp_port=self.server.port)
+        queue.stop(10)
+        self.assertEqual(queue._thread, None)
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertTrue('Subject: sent' in self.server.messages[0][1])
+
+    def test_empty_flush(self):
+        """Flushing an empty queue doesn't send the next mail at once.
+        """
+        queue = MailQueue()
+        options = dict(smtp_host='127.0.0.1', smtp_port=self.server.port,
+                       max_delay=0.5)
+        queue.put('admin@example.org', 'first', 'body', **options)
+        queue.flush()
+        time.sleep(0.2)
+        self.assertEqual(len(self.server.messages), 1)
+        queue.flush()
+        for i in xrange(10):
+            queue.put('admin@example.org', 'alert %d' % i, 'body', **options)
+            time.sleep(0.01)
+        queue.stop(10)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertTrue('Subject: [timyd] 10 alerts' in
+                        self.server.messages[1][1])
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from timyd import query
+from timyd.logged_properties import BinaryLog
+
+
+class Test_query(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='timyd_test_')
+        os.mkdir(os.path.join(self.dir, 'site'))
+        with BinaryLog(self.path('web')) as log:
+            log.set_property('status', '', t=1000)
+            log.set_property('version', '1.0', t=1000)
+            log.set_property('status', 'CantConnect', t=1600)
+            log.set_property('status', '', t=1800)
+            log.set_property('version', '1.1', t=1800)
+            log.set_property('version', '1.2', t=2500)
+        with BinaryLog(self.path('mail')) as log:
+            log.set_property('status', 'TimedOut', t=1500)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, service):
+        return os.path.join(self.dir, 'site', '%s.binlog' % service)
+
+    def test_list_logs(self):
+        self.assertEqual(query.list_logs(self.dir, 'site'),
+                         [('mail', self.path('mail')),
+                          ('web', self.path('web'))])
+        self.assertEqual(query.list_logs(self.dir, 'site', ['web']),
+                         [('web', self.path('web'))])
+        self.assertRaises(ValueError, query.list_logs, self.dir, 'site',
+                          ['ftp'])
+        self.assertRaises(ValueError, query.list_logs, self.dir, 'other')
+
+    def test_status(self):
+        logs = query.list_logs(self.dir, 'site')
+        self.assertEqual(query.run_query(query.status, logs),
+                         [('mail', ('TimedOut', 1500)),
+                          ('web', ('', 1800))])
+
+    def test_invalid(self):
+        """Skips the logs that can't be read.
+        """
+        with open(self.path('mail'), 'r+b') as fp:
+            fp.truncate(30)
+        logs = query.list_logs(self.dir, 'site')
+        self.assertEqual(query.run_query(query.status, logs),
+                         [('web', ('', 1800))])
+
+        # Summary of a BINLOG01 log dropped by a writer
+        with BinaryLog(self.path('ftp'), version=1) as log:
+            log.set_property('status', '', t=1000)
+        with BinaryLog(self.path('ftp')) as writer:
+            writer.set_property('status', 'CantConnect', t=2000)
+            logs = query.list_logs(self.dir, 'site', ['ftp', 'web'])
+            self.assertEqual(query.run_query(query.status, logs),
+                             [('web', ('', 1800))])
+        self.assertEqual(query.status(self.path('ftp')),
+                         ('CantConnect', 2000))
+
+    def test_changes(self):
+        self.assertEqual(query.changes(self.path('web'), 'version'),
+                         [(1000, '1.0'), (1800, '1.1'), (2500, '1.2')])
+        self.assertEqual(query.changes(self.path('web'), 'version',
+                                       1500, 2000),
+                         [(1800, '1.1')])
+        self.assertEqual(query.changes(self.path('mail'), 'version'), [])
+
+    def test_uptime(self):
+        self.assertEqual(query.uptime(self.path('web'), 1000, 2000), 0.8)
+        self.assertEqual(query.uptime(self.path('web'), 1700, 2000),
+                         2.0 / 3)
+        # Nothing known before the first check
+        self.assertEqual(query.uptime(self.path('web'), 0, 2000), 0.8)
+        self.assertEqual(query.uptime(self.path('mail'), 0, 2000), 0.0)
+        self.assertEqual(query.uptime(self.path('mail'), 0, 1000), None)
+
+    def test_parse_time(self):
+        self.assertEqual(query.parse_time('1500'), 1500)
+        self.assertEqual(query.parse_time('1970-01-02'), 86400)
+        self.assertEqual(query.parse_time('1970-01-01T01:00'), 3600)
+        self.assertRaises(ValueError, query.parse_time, 'yesterday')
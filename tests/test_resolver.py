@@ -0,0 +1,61 @@
+import socket
+import threading
+import time
+import unittest
+
+from timyd.resolver import Resolver
+
+
+class Test_resolver(unittest.TestCase):
+    def setUp(self):
+        self.lookups = []
+        self._getaddrinfo = socket.getaddrinfo
+
+        def getaddrinfo(host, port, *args):
+            self.lookups.append(host)
+            time.sleep(0.2)
+            if host.endswith('.invalid'):
+                raise socket.gaierror(socket.EAI_NONAME, "Name unknown")
+            return self._getaddrinfo(host, port, *args)
+        socket.getaddrinfo = getaddrinfo
+
+    def tearDown(self):
+        socket.getaddrinfo = self._getaddrinfo
+
+    def test_cache(self):
+        resolver = Resolver(ttl=0.5)
+        self.assertEqual(resolver.getaddrinfo('127.0.0.1', 22)[0][4],
+                         ('127.0.0.1', 22))
+        # Same name, other port: not resolved again
+        self.assertEqual(resolver.getaddrinfo('127.0.0.1', 25)[0][4],
+                         ('127.0.0.1', 25))
+        self.assertEqual(self.lookups, ['127.0.0.1'])
+        time.sleep(0.5)
+        resolver.getaddrinfo('127.0.0.1', 25)
+        self.assertEqual(self.lookups, ['127.0.0.1'] * 2)
+
+    def test_negative(self):
+        resolver = Resolver(negative_ttl=60)
+        for i in xrange(2):
+            self.assertRaises(socket.gaierror,
+                              resolver.getaddrinfo, 'host.invalid', 22)
+        self.assertEqual(self.lookups, ['host.invalid'])
+
+    def test_prefetch(self):
+        """Resolves names concurrently, and each one once.
+        """
+        resolver = Resolver()
+        start = time.time()
+        threads = [threading.Thread(target=resolver.prefetch,
+                                    args=(['127.0.0.1', 'localhost',
+                                           'host.invalid'],))
+                   for i in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(sorted(self.lookups),
+                         ['127.0.0.1', 'host.invalid', 'localhost'])
+        resolver.getaddrinfo('localhost', 22)
+        self.assertEqual(len(self.lookups), 3)
@@ -0,0 +1,285 @@
+import logging
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from timyd import Action, SiteManager
+from timyd.logged_properties import BinaryLog
+from timyd.daemon import Scheduler
+from timyd.run import Runner, compact_main
+
+
+SITE = '''
+import logging
+import os
+import time
+
+from timyd import CheckFailure, Service, Site
+
+
+checked = []
+
+
+class Sleeping(Service):
+    def check(self):
+        start = time.time()
+        time.sleep(0.3)
+        checked.append((self.name, start, time.time()))
+
+
+site = Site()
+first = Sleeping('first')
+site.add_check(first)
+for i in xrange(4):
+    site.add_check(Sleeping('second%d' % i), dependencies=(first,))
+
+
+class Counting(Service):
+    count = 0
+
+    def check(self):
+        self.count += 1
+        self.set_property('pid', os.getpid())
+
+
+site.add_check(Counting('fast'), interval=0.2)
+site.add_check(Counting('slow'), interval=60)
+
+
+class Failure(CheckFailure):
+    def __init__(self, code, msg):
+        self.code = code
+        self.msg = msg
+
+    def __str__(self):
+        return "%d %s" % (self.code, self.msg)
+
+
+class Pid(Service):
+    def check(self):
+        self.set_property('pid', os.getpid())
+        logging.getLogger('timyd_test').debug("checked in %d", os.getpid())
+        if self.name == 'failing':
+            raise Failure(500, "failed")
+
+
+for name in ('pid0', 'pid1', 'failing'):
+    site.add_check(Pid(name))
+
+
+class Dependent(Service):
+    def dependencies(self):
+        # Not added to the site
+        return Pid('hidden')
+
+    def check(self):
+        pass
+
+
+site.add_check(Dependent('dependent'))
+'''
+
+
+class Recorder(Action):
+    def __init__(self):
+        self.properties = dict()
+        self.errors = dict()
+        self.checked = []
+
+    def register_property_change(self, site, service, name,
+            old_value, new_value):
+        self.properties[(service, name)] = new_value
+
+    def register_service_check(self, site, service,
+            old_status, status, error, warnings):
+        self.checked.append((service, status))
+        if error is not None:
+            self.errors[service] = error
+
+
+class Test_run(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='timyd_test_')
+        # Different module name for each test, as they stay in sys.modules
+        self.module = 'site_%s' % self._testMethodName
+        self.site = os.path.join(self.dir, '%s.py' % self.module)
+        with open(self.site, 'w') as fp:
+            fp.write(SITE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_jobs(self):
+        """Runs independent checks concurrently, after their dependencies.
+        """
+        runner = Runner(self.site, verbosity=0, textoutput=False,
+                        colors=None, logs=os.path.join(self.dir, 'logs'),
+                        jobs=4)
+        runner.check_site()
+        self.assertEqual(runner.site.services['second2'].status, '')
+        runner.end_run()
+
+        checked = sys.modules[self.module].checked
+        names = [name for name, start, end in checked]
+        self.assertEqual(names[0], 'first')
+        self.assertEqual(sorted(names[1:5]),
+                         ['second%d' % i for i in xrange(4)])
+        # The dependency first, then all the others at once
+        self.assertTrue(all(start >= checked[0][2]
+                            for name, start, end in checked[1:]))
+        self.assertTrue(max(start for name, start, end in checked[1:]) <
+                        min(end for name, start, end in checked[1:]))
+
+    def test_log_pool(self):
+        """Keeps the logs open from one run to the next.
+        """
+        runner = Runner(self.site, verbosity=0, textoutput=False,
+                        colors=None, logs=os.path.join(self.dir, 'logs'),
+                        jobs=1, log_pool=3)
+        try:
+            runner.check_services(['second0'])
+            first = runner.site.services['first']
+            log = first._log
+            evicted = runner.site.services['second0']._log
+            runner.end_run()
+            self.assertEqual(first._log, None)
+            self.assertFalse(log._file is None)
+
+            runner.check_services(['second1'])
+            self.assertTrue(first._log is log)
+            self.assertEqual(first.status, '')
+            runner.end_run()
+
+            runner.check_services(['second2', 'second3'])
+            runner.end_run()
+            # 'second0' was the least recently used
+            self.assertTrue(evicted._file is None)
+            self.assertFalse(log._file is None)
+        finally:
+            SiteManager.close_logs()
+
+    def test_property_cache(self):
+        """Reads the properties from the log only once.
+        """
+        runner = Runner(self.site, verbosity=0, textoutput=False,
+                        colors=None, logs=os.path.join(self.dir, 'logs'),
+                        jobs=1, log_pool=3)
+        try:
+            runner.check_services(['pid0'])
+            service = runner.site.services['pid0']
+            log = service._log
+            reads = []
+            get_property = log.get_property
+            def counting_get_property(prop):
+                reads.append(prop)
+                return get_property(prop)
+            log.get_property = counting_get_property
+            runner.end_run()
+
+            runner.check_services(['pid0'])
+            self.assertEqual(service.status, '')
+            self.assertEqual(service.get_property('pid'), os.getpid())
+            runner.end_run()
+            self.assertEqual(reads, [])
+
+            # Read from the log if not known
+            service._property_values = dict()
+            runner.check_services(['pid0'])
+            self.assertEqual(service.get_property('pid'), os.getpid())
+            runner.end_run()
+            self.assertEqual(sorted(reads), ['pid', 'status'])
+        finally:
+            SiteManager.close_logs()
+
+    def test_daemon(self):
+        """Checks each service on its own interval.
+        """
+        runner = Runner(self.site, verbosity=0, textoutput=False,
+                        colors=None, logs=os.path.join(self.dir, 'logs'),
+                        jobs=8, log_pool=16)
+        scheduler = Scheduler(runner, interval=30, jitter=0.1)
+        threading.Timer(2.0, scheduler.stop).start()
+        scheduler.run_forever()
+        services = runner.site.services
+        self.assertTrue(3 <= services['fast'].count <= 12)
+        self.assertEqual(services['slow'].count, 1)
+
+    def test_processes(self):
+        """Checks in several processes, with the actions in the parent.
+        """
+        logs = os.path.join(self.dir, 'logs')
+        runner = Runner(self.site, verbosity=0, textoutput=False,
+                        colors=None, logs=logs, jobs=2, processes=3)
+        recorder = Recorder()
+        runner.site.add_action(recorder)
+
+        # A thread logging while the workers are forked
+        logger = logging.getLogger('timyd_test')
+        handler = logging.Handler()
+        handler.emit = lambda record: None
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        def logging_thread():
+            with handler.lock:
+                locked.set()
+                time.sleep(0.5)
+        locked = threading.Event()
+        threading.Thread(target=logging_thread).start()
+        locked.wait()
+        try:
+            runner.check_site()
+        finally:
+            logger.removeHandler(handler)
+        runner.end_run()
+
+        services = runner.site.services
+        self.assertEqual(
+                set(s.name for s in runner._checked_services),
+                set(services) | set(['hidden']))
+        self.assertEqual(sorted(name for name, status in recorder.checked),
+                         sorted(services))
+        # The shards are filled with the independent services in turn
+        pids = set(recorder.properties[(name, 'pid')]
+                   for name in ('fast', 'slow', 'pid0', 'pid1', 'failing'))
+        self.assertFalse(os.getpid() in pids)
+        self.assertTrue(len(pids) > 1)
+        error = recorder.errors['failing']
+        self.assertEqual((error.name, str(error)), ('Failure', "500 failed"))
+        # The statuses were written by the workers
+        with BinaryLog(os.path.join(logs, self.module, 'failing.binlog'),
+                       readonly=True) as log:
+            self.assertEqual(log.get_property('status')[1], 'Failure')
+
+    def test_compact_errors(self):
+        """Goes on compacting the logs after an error, unlocking the log.
+        """
+        logs = os.path.join(self.dir, 'logs')
+        os.makedirs(os.path.join(logs, 'site'))
+        paths = [os.path.join(logs, 'site', '%s.binlog' % name)
+                 for name in ('a', 'b')]
+        for path in paths:
+            with BinaryLog(path) as log:
+                log.set_property('status', '', t=1000)
+
+        compact = BinaryLog.compact
+        def failing(log, *args):
+            if log._filename == paths[0]:
+                raise IOError("No space left on device")
+            return compact(log, *args)
+        BinaryLog.compact = failing
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            self.assertRaises(SystemExit, compact_main, ['-l', logs, 'site'])
+            output = sys.stdout.getvalue()
+        finally:
+            BinaryLog.compact = compact
+            sys.stdout = stdout
+        self.assertEqual(output.splitlines(),
+                         ["b: 1 -> 1 records, %d -> %d bytes" % (
+                                 (os.path.getsize(paths[1]),) * 2)])
+        BinaryLog(paths[0]).close()
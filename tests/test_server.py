@@ -0,0 +1,321 @@
+import socket
+import threading
+import time
+import unittest
+
+from timyd import CheckFailure, SiteManager, _Site
+from timyd.checks.server import SSHService, SMTPService, CantConnect, \
+    TimedOut
+from timyd.checks.server.server import LineReader
+from timyd import eventloop
+from timyd.eventloop import EventLoop
+
+
+class BannerServer(object):
+    """Local server sending an SSH banner after a delay.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            threading.Thread(target=self._banner, args=(conn,)).start()
+
+    def _banner(self, conn):
+        time.sleep(self.delay)
+        conn.sendall("SSH-2.0-timyd_test\r\n")
+        conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class SMTPServer(BannerServer):
+    """Local server going through the start of an SMTP session.
+    """
+
+    def __init__(self, ehlo_reply):
+        self.ehlo_reply = ehlo_reply
+        self.received = []
+        self.done = threading.Event()
+        BannerServer.__init__(self, 0)
+
+    def _banner(self, conn):
+        conn.sendall("220-mail.example.org ESMTP\r\n220 timyd_test\r\n")
+        fp = conn.makefile()
+        self.received.append(fp.readline())
+        conn.sendall(self.ehlo_reply)
+        self.received.append(fp.readline())
+        conn.sendall("221 Bye\r\n")
+        fp.close()
+        conn.close()
+        self.done.set()
+
+
+class SynchronousSSH(SSHService):
+    """SSH check with a blocking connected_check(), reusing the parent's.
+    """
+
+    def connected_check(self, s, addrinfo):
+        self.reader = s
+        return SSHService.connected_check(self, s, addrinfo)
+
+
+def make_service(name, port, cls=SSHService, site=None):
+    service = cls(name, '127.0.0.1', port)
+    service.site = site or _Site('test')
+    service._warnings = []
+    return service
+
+
+class Test_server_checks(unittest.TestCase):
+    def setUp(self):
+        self.server = BannerServer(0.3)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_sync(self):
+        """Runs a ported check through the synchronous API.
+        """
+        service = make_service('ssh', self.server.port)
+        service.check()
+        self.assertEqual(service.banner, "SSH-2.0-timyd_test")
+        self.assertEqual(service.addresses,
+                         "127.0.0.1:%d connected" % self.server.port)
+        service.end_run()
+
+    def test_subclasses(self):
+        """Runs the check() and connected_check() of subclasses.
+        """
+        class Failing(SSHService):
+            def check(self):
+                raise CheckFailure
+
+        service = make_service('failing', self.server.port, Failing)
+        self.assertEqual(service.check_task(), None)
+        service = make_service('sync', self.server.port, SynchronousSSH)
+        self.assertEqual(service.check_task(), None)
+        service.check()
+        self.assertTrue(isinstance(service.reader, LineReader))
+        self.assertEqual(service.banner, "SSH-2.0-timyd_test")
+        service.end_run()
+
+    def test_loop(self):
+        """Runs many checks concurrently on a single event loop.
+        """
+        site = _Site('test')
+        services = [make_service('ssh%d' % i, self.server.port, site=site)
+                    for i in xrange(20)]
+        loop = EventLoop()
+        start = time.time()
+        futures = [loop.spawn(service.check_task()) for service in services]
+        for future in futures:
+            loop.run_until_complete(future)
+        self.assertTrue(time.time() - start < 2.0)
+        loop.close()
+        for service in services:
+            self.assertEqual(service.banner, "SSH-2.0-timyd_test")
+        self.assertEqual(self.server.connections, 20)
+
+    def test_shared_probe(self):
+        """Checks of the same server share a single connection per run.
+        """
+        site = _Site('test')
+        services = [make_service('ssh%d' % i, self.server.port, site=site)
+                    for i in xrange(5)]
+        for service in services:
+            service.share_probes = True
+        loop = EventLoop()
+        for run in xrange(2):
+            futures = [loop.spawn(service.check_task())
+                       for service in services]
+            for future in futures:
+                loop.run_until_complete(future)
+            for service in services:
+                self.assertEqual(service.banner, "SSH-2.0-timyd_test")
+            site.end_run()
+            self.assertEqual(self.server.connections, run + 1)
+        loop.close()
+
+        services[0].check()
+        services[1].check()
+        self.assertEqual(self.server.connections, 3)
+        site.end_run()
+
+        # Not shared with the services of other sites
+        other = make_service('ssh', self.server.port)
+        other.share_probes = True
+        services[0].check()
+        other.check()
+        self.assertEqual(self.server.connections, 5)
+        site.end_run()
+        other.end_run()
+
+    def test_adaptive_timeouts(self):
+        """Derives the timeouts and warnings from the latency history.
+        """
+        service = make_service('ssh', self.server.port)
+        self.assertEqual(service.get_timeout('banner'), 10.0)
+        for i in xrange(20):
+            service.record_metric('banner_latency', 250)
+        self.assertEqual(service.get_timeout('banner'), 1.0)
+        # The history of each step is only read once (the banner's by
+        # get_timeout() above), then kept in memory
+        reads = []
+        get_metric_history = service.get_metric_history
+        def counting(prop, count):
+            reads.append(prop)
+            return get_metric_history(prop, count)
+        service.get_metric_history = counting
+        for i in xrange(2):
+            service.check()
+            service.end_run()
+        self.assertEqual(reads, ['connect_latency'])
+        del service.get_metric_history
+        self.assertEqual(list(service._latency_history['banner'])[:-2],
+                         [250] * 20)
+        self.assertEqual(list(service._latency_history['banner'])[-2:],
+                         service.get_metric_history('banner_latency', 2)[::-1])
+        self.assertEqual(service._warnings, [])
+        latency = service.get_metric_history('banner_latency', 1)[0]
+        self.assertTrue(300 <= latency < 1000)
+
+        # Fast server, slower than usual
+        service = make_service('ssh', self.server.port)
+        for i in xrange(20):
+            service.record_metric('banner_latency', 50)
+        service.check()
+        service.end_run()
+        self.assertEqual([name for name, msg in service._warnings], ['ping'])
+
+        # Fails fast, and records the timeout, with both kinds of checks
+        server = BannerServer(3)
+        try:
+            for cls in (SSHService, SynchronousSSH):
+                service = make_service('ssh', server.port, cls)
+                for i in xrange(20):
+                    service.record_metric('banner_latency', 50)
+                start = time.time()
+                self.assertRaises(TimedOut, service.check)
+                service.end_run()
+                self.assertTrue(time.time() - start < 2.0)
+                self.assertEqual(
+                        service.get_metric_history('banner_latency', 1),
+                        [1000])
+        finally:
+            server.close()
+
+    def test_cant_connect(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close() # never listened on
+        site = _Site('test')
+        service = make_service('ssh', port, site=site)
+        service.share_probes = True
+        self.assertRaises(CantConnect, service.check)
+        self.assertEqual(service.addresses,
+                         "127.0.0.1:%d ECONNREFUSED" % port)
+        # Shared probe: same error
+        other = make_service('ssh2', port, site=site)
+        other.share_probes = True
+        self.assertRaises(CantConnect, other.check)
+        self.assertEqual(other.addresses, service.addresses)
+        service.end_run()
+        other.end_run()
+
+    def test_staggered(self):
+        """Connects to the fastest address rather than waiting on each.
+        """
+        # Listening socket with a full backlog: connections hang
+        blackhole = socket.socket()
+        blackhole.bind(('127.0.0.1', 0))
+        blackhole.listen(0)
+        filler = socket.socket()
+        filler.connect(blackhole.getsockname())
+        refused = socket.socket()
+        refused.bind(('127.0.0.1', 0))
+
+        def info(sock):
+            return (socket.AF_INET, socket.SOCK_STREAM, 0, '',
+                    sock.getsockname())
+        addresses = [info(blackhole), info(refused), info(self.server.sock)]
+        refused.close()
+        try:
+            start = time.time()
+            sock, connected, outcomes = eventloop.run(
+                    eventloop.connect_staggered(addresses, 0.25, 5))
+            self.assertTrue(time.time() - start < 2.0)
+            sock.close()
+            self.assertTrue(connected is addresses[2])
+            self.assertEqual([outcome for i, outcome in outcomes],
+                             ['abandoned', 'ECONNREFUSED', 'connected'])
+
+            start = time.time()
+            sock, connected, outcomes = eventloop.run(
+                    eventloop.connect_staggered(addresses[:2], 0.25, 0.5))
+            self.assertTrue(time.time() - start < 2.0)
+            self.assertEqual((sock, connected), (None, None))
+            self.assertEqual([outcome for i, outcome in outcomes],
+                             ['timeout', 'ECONNREFUSED'])
+
+            # The transient outcomes are not recorded by the checks
+            service = make_service('ssh', self.server.port)
+            resolver = SiteManager.resolver
+            resolver.getaddrinfo = lambda host, port: addresses
+            try:
+                service.check()
+            finally:
+                del resolver.getaddrinfo
+            self.assertEqual(service.addresses,
+                             "127.0.0.1:%d ECONNREFUSED, "
+                             "127.0.0.1:%d connected" % (
+                                     addresses[1][4][1], self.server.port))
+            self.assertEqual(
+                    service.get_metric_history('timeout_addresses', 1), [0])
+            service.end_run()
+        finally:
+            filler.close()
+            blackhole.close()
+
+
+class Test_smtp(unittest.TestCase):
+    def test_ehlo(self):
+        """Reads the multi-line greeting and reply to EHLO.
+        """
+        server = SMTPServer("250-mail.example.org\r\n250-PIPELINING\r\n"
+                            "250 8BITMIME\r\n")
+        try:
+            service = make_service('smtp', server.port, SMTPService)
+            service.check()
+            service.end_run()
+            self.assertEqual(service.banner, "220 mail.example.org ESMTP")
+            self.assertTrue(server.done.wait(5))
+            self.assertEqual(server.received, [
+                    "EHLO smtp_test.monitor.org\r\n", "QUIT\r\n"])
+        finally:
+            server.close()
+
+    def test_ehlo_rejected(self):
+        server = SMTPServer("550 Go away\r\n")
+        try:
+            service = make_service('smtp', server.port, SMTPService)
+            self.assertRaises(SMTPService.ProtocolMismatch, service.check)
+            service.end_run()
+        finally:
+            server.close()
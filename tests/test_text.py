@@ -0,0 +1,71 @@
+import json
+import StringIO
+import unittest
+
+from timyd.actions.text import TextOutput
+from timyd.console import colors
+
+
+class Test_text_output(unittest.TestCase):
+    def setUp(self):
+        self._colors = colors._enabled
+        colors.enable(False)
+
+    def tearDown(self):
+        colors.enable(self._colors)
+
+    def run_events(self, output):
+        output.register_service_check('site', 'ssh', None, '', None, [])
+        output.register_property_change('site', 'ssh', 'banner',
+                                        'SSH-1', 'SSH-2')
+        output.register_service_check('site', 'smtp', '', 'CantConnect',
+                                      Exception("Can't connect"),
+                                      [('ping', "slow")])
+
+    def test_text(self):
+        expected = ("[service check] site.ssh: OK\n"
+                    "[property change] site.ssh: banner: SSH-2 (was SSH-1)\n"
+                    "[warning] ping: slow\n"
+                    "[service check] site.smtp: CantConnect (was OK)\n")
+
+        # Written as the events happen
+        stream = StringIO.StringIO()
+        output = TextOutput(stream=stream)
+        self.run_events(output)
+        self.assertEqual(stream.getvalue(), expected)
+        output.end_run()
+        self.assertEqual(stream.getvalue(), expected)
+
+        # Buffered
+        stream = StringIO.StringIO()
+        output = TextOutput(stream=stream, flush_every=10)
+        self.run_events(output)
+        self.assertEqual(stream.getvalue(), '')
+        output.end_run()
+        self.assertEqual(stream.getvalue(), expected)
+
+    def test_table(self):
+        stream = StringIO.StringIO()
+        output = TextOutput('table', stream=stream)
+        self.run_events(output)
+        output.end_run()
+        self.assertEqual(stream.getvalue(),
+                "site.ssh   OK\n"
+                "site.ssh   banner: SSH-2  SSH-1\n"
+                "site.smtp  CantConnect    OK     slow\n")
+        # The widths of the columns would change between blocks
+        self.assertRaises(ValueError, TextOutput, 'table', flush_every=2)
+
+    def test_json(self):
+        stream = StringIO.StringIO()
+        output = TextOutput('json', stream=stream, flush_every=2)
+        self.run_events(output)
+        self.assertEqual(len(stream.getvalue().splitlines()), 2)
+        output.end_run()
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([e['event'] for e in events],
+                         ['check', 'property', 'check'])
+        self.assertEqual(events[1]['new_value'], 'SSH-2')
+        self.assertEqual((events[2]['status'], events[2]['error'],
+                          events[2]['warnings']),
+                         ('CantConnect', "Can't connect", [['ping', 'slow']]))
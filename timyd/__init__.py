@@ -1,8 +1,14 @@
+import collections
+import itertools
 import logging
 import os
 import sys
+import threading
+import time
 
+from timyd.dispatch import EventQueue
 from timyd.logged_properties import BinaryLog, StringProperty
+from timyd.resolver import Resolver
 
 
 class CheckFailure(Exception):
@@ -12,36 +18,104 @@ class CheckFailure(Exception):
 class Service(object):
     status = StringProperty('status')
 
+    # Seconds between two checks in daemon mode; None uses the default
+    interval = None
+
     def __init__(self, name):
         self.name = name
         self.site = None
         self._log = None
+        # Latest value of the properties, read from the log once; the only
+        # store if there is no log
         self._property_values = dict()
+        self._metric_values = dict() # used without a log
 
-    def _do_check(self):
+    def _start_check(self):
         if self._log is None:
             self._log = SiteManager.get_log_for_service(
                     self.site.name, self.name)
+        if self._log is not None:
+            # All the changes of this check are written at once
+            self._log.begin_batch()
         logging.info("Running test for service %s" % self.name)
         try:
             old_status = self.status
         except KeyError:
             old_status = None
         self._warnings = []
+        return old_status
+
+    def _end_check(self, old_status, e):
+        if e is not None:
+            status = e.__class__.__name__
+        else:
+            status = ''
+        try:
+            self.site.service_checked(
+                    self,
+                    old_status, status, e, self._warnings)
+            if status != old_status:
+                self.site.status_changed(self, old_status, status)
+            self.status = status
+            self._warnings = None
+        finally:
+            if self._log is not None:
+                self._log.end_batch()
+
+    def _abort_check(self):
+        self._warnings = None
+        if self._log is not None:
+            self._log.end_batch()
+
+    def _do_check(self):
+        old_status = self._start_check()
         try:
             self.check()
         except CheckFailure, e:
-            status = e.__class__.__name__
+            pass
+        except:
+            self._abort_check()
+            raise
         else:
-            status = ''
             e = None
-        self.site.service_checked(
-                self,
-                old_status, status, e, self._warnings)
-        if status != old_status:
-            self.site.status_changed(self, old_status, status)
-        self.status = status
-        self._warnings = None
+        self._end_check(old_status, e)
+
+    def _do_check_task(self):
+        """Returns a coroutine doing _do_check() on an EventLoop, or None.
+        """
+        task = self.check_task()
+        if task is None:
+            return None
+        return self._run_check_task(task)
+
+    def _run_check_task(self, task):
+        old_status = self._start_check()
+        try:
+            yield task
+        except CheckFailure, e:
+            pass
+        except:
+            self._abort_check()
+            raise
+        else:
+            e = None
+        self._end_check(old_status, e)
+
+    def check_task(self):
+        """Returns a coroutine performing the check, or None.
+
+        Checks that can run on an EventLoop (see timyd.eventloop) override
+        this, so that many of them can wait on the network from a single
+        thread. Others are run by calling check() in a worker thread.
+        """
+        return None
+
+    def hostnames(self):
+        """Returns the names of the hosts this check connects to.
+
+        They are resolved in advance, all at once, at the start of a run.
+        """
+        return ()
 
     def warning(self, name, msg):
         logging.warning("%s.%s warning '%s': %s" % (
@@ -50,13 +124,18 @@ class Service(object):
 
     def end_run(self):
         if self._log is not None:
-            self._log.close()
+            SiteManager.release_log(self.site.name, self.name, self._log)
+            self._log = None
 
     def get_property(self, prop):
-        if self._log is not None:
-            return self._log.get_property(prop)[1]
-        else:
+        try:
             return self._property_values[prop]
+        except KeyError:
+            if self._log is None:
+                raise
+        value = self._log.get_property(prop)[1] # might raise KeyError
+        self._property_values[prop] = value
+        return value
 
     def set_property(self, prop, value):
         try:
@@ -69,8 +148,34 @@ class Service(object):
             self.site.property_changed(self, prop, old_value, value)
         if self._log is not None:
             self._log.set_property(prop, value)
+        self._property_values[prop] = value
+
+    def record_metric(self, prop, value):
+        """Records a measurement, as an integer property.
+
+        Unlike set_property(), the actions are not notified: metrics such as
+        latencies change on every check.
+        """
+        if self._log is not None:
+            self._log.set_property(prop, value)
+            self._property_values.pop(prop, None)
+        else:
+            history = self._metric_values.setdefault(
+                    prop, collections.deque(maxlen=1000))
+            history.appendleft(value)
+
+    def get_metric_history(self, prop, count):
+        """Returns the last values of a metric, most recent first.
+        """
+        if self._log is not None:
+            try:
+                history = self._log.get_property_history(prop, dir=-1)
+            except KeyError:
+                return []
+            return [value for t, value in itertools.islice(history, count)]
         else:
-            self._property_values[prop] = value
+            return list(itertools.islice(self._metric_values.get(prop, ()),
+                                         count))
 
 
 class Action(object):
@@ -128,9 +233,54 @@ class SiteManager(object):
     def __init__(self):
         self._next_site = None
         self._sites = dict()
+        self._lock = threading.Lock()
+
+        # Pool of open logs, (site, service) -> BinaryLog, least recently
+        # used first
+        self._logs = collections.OrderedDict()
+        self._logs_in_use = set()
+        self._log_dirs = set()
+        self._pool_size = 0
+        self._flush_interval = 300
+        self._last_flush = time.time()
+        self._journal = True
+
+        # DNS cache, shared by all the checks
+        self.resolver = Resolver()
+
+        # Size of the queues of events for the actions; 0 calls them from
+        # the checks
+        self.event_queue = 1024
 
     def configure(self, **options):
+        """Sets up the SiteManager.
+
+        logs is the directory where the logs are written.
+        log_pool is the number of logs to keep open between runs (default: 0,
+        logs are closed at the end of each run). Summaries of the logs kept
+        open are written every flush_interval seconds (default: 300), and
+        when a log is evicted from the pool.
+        With journal (default: True), the changes are also written to a
+        journal until the log is flushed, so that it can be recovered if the
+        process dies, and logs are synced to disk when flushed.
+        Resolved names are cached for dns_ttl seconds (default: 300), and
+        resolution failures for dns_negative_ttl seconds (default: 60).
+        The actions are called from another thread, through a queue of up to
+        event_queue events (default: 1024); with 0, they are called directly
+        by the checks.
+        """
         self._log_location = options['logs']
+        self._pool_size = options.get('log_pool') or 0
+        if options.get('flush_interval') is not None:
+            self._flush_interval = options['flush_interval']
+        if options.get('journal') is not None:
+            self._journal = options['journal']
+        if options.get('dns_ttl') is not None:
+            self.resolver.ttl = options['dns_ttl']
+        if options.get('dns_negative_ttl') is not None:
+            self.resolver.negative_ttl = options['dns_negative_ttl']
+        if options.get('event_queue') is not None:
+            self.event_queue = options['event_queue']
 
     def prepare_site(self, sitename):
         self._next_site = _Site(sitename)
@@ -147,13 +297,74 @@ class SiteManager(object):
     def get_log_for_service(self, site, service):
         if service not in self._sites[site].services:
             return None
-        path = self._log_location
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        path = os.path.join(path, site)
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        return BinaryLog(os.path.join(path, '%s.binlog' % service))
+        key = (site, service)
+        with self._lock: # checks might be running in several threads
+            log = self._logs.pop(key, None)
+            if log is not None:
+                self._logs[key] = log # most recently used
+                self._logs_in_use.add(key)
+                return log
+            path = os.path.join(self._log_location, site)
+            if path not in self._log_dirs:
+                if not os.path.isdir(self._log_location):
+                    os.mkdir(self._log_location)
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+                self._log_dirs.add(path)
+        log = BinaryLog(os.path.join(path, '%s.binlog' % service),
+                        journal=self._journal)
+        if self._pool_size:
+            with self._lock:
+                self._logs[key] = log
+                self._logs_in_use.add(key)
+                self._evict_logs()
+        return log
+
+    def release_log(self, site, service, log):
+        """Gives back a log obtained from get_log_for_service().
+
+        The log is closed, unless logs are pooled.
+        """
+        key = (site, service)
+        with self._lock:
+            self._logs_in_use.discard(key)
+            if self._logs.get(key) is not log:
+                log.close()
+                return
+            self._evict_logs()
+            if time.time() - self._last_flush >= self._flush_interval:
+                self._flush_logs()
+
+    def _evict_logs(self):
+        if len(self._logs) <= self._pool_size:
+            return
+        for key in list(self._logs):
+            if key not in self._logs_in_use:
+                logging.debug("closing log for %s.%s" % key)
+                self._logs.pop(key).close()
+                if len(self._logs) <= self._pool_size:
+                    return
+
+    def _flush_logs(self):
+        logging.debug("flushing %d logs" % len(self._logs))
+        for key, log in self._logs.iteritems():
+            if key not in self._logs_in_use:
+                log.flush()
+        self._last_flush = time.time()
+
+    def flush_logs(self):
+        """Writes the summaries of all the pooled logs not currently in use.
+        """
+        with self._lock:
+            self._flush_logs()
+
+    def close_logs(self):
+        """Closes all the pooled logs not currently in use.
+        """
+        with self._lock:
+            for key in list(self._logs):
+                if key not in self._logs_in_use:
+                    self._logs.pop(key).close()
 
 
 SiteManager = SiteManager()
@@ -188,9 +399,19 @@ class Site(object):
         self.services = dict() # Service#name -> Service
         self._dependencies = dict() # Service -> tuple(Service)
         self.actions = list() # [Action]
-
-    def add_check(self, service, dependencies=()):
+        # Actions are not expected to be thread-safe; this serializes the
+        # calls made from the worker threads of a parallel run
+        self._actions_lock = threading.RLock()
+        self._events = None # EventQueue, created on first use
+        # Probes shared by the checks of the current run, key -> Future; see
+        # ServerService.share_probes
+        self.probes = dict()
+        self.probes_lock = threading.Lock()
+
+    def add_check(self, service, dependencies=(), interval=None):
         service.site = self
+        if interval is not None:
+            service.interval = interval
         self.services[service.name] = service
         self._dependencies[service] = dependencies
         if hasattr(service, 'dependencies'):
@@ -211,34 +432,56 @@ class Site(object):
         action.site = self
         self.actions.append(action)
 
+    def _dispatch(self, method, *args):
+        if not self.actions:
+            return
+        with self._actions_lock:
+            if self._events is None and SiteManager.event_queue:
+                self._events = EventQueue(self, SiteManager.event_queue)
+        if self._events is not None:
+            self._events.put(method, *args)
+            return
+        with self._actions_lock:
+            for action in self.actions:
+                getattr(action, method)(self.name, *args)
+
     def service_checked(self, service, old_status, new_status,
             error, warnings):
         if service.name not in self.services:
             return
-        for action in self.actions:
-            action.register_service_check(
-                    self.name, service.name,
-                    old_status, new_status, error, warnings)
+        self._dispatch('register_service_check', service.name,
+                       old_status, new_status, error, warnings)
 
     def status_changed(self, service, old_status, new_status):
         if service.name not in self.services:
             return
-        for action in self.actions:
-            action.register_status_change(
-                    self.name, service.name,
-                    old_status, new_status)
+        self._dispatch('register_status_change', service.name,
+                       old_status, new_status)
 
     def property_changed(self, service, name, old_value, new_value):
         if service.name not in self.services:
             return
-        for action in self.actions:
-            action.register_property_change(
-                    self.name, service.name, name,
-                    old_value, new_value)
+        self._dispatch('register_property_change', service.name, name,
+                       old_value, new_value)
+
+    def event_stats(self):
+        """Returns statistics about the queue of events, or None.
+
+        See EventQueue.stats().
+        """
+        if self._events is None:
+            return None
+        return self._events.stats()
 
     def end_run(self):
         for service in self.services.itervalues():
             service.end_run()
+        with self.probes_lock:
+            self.probes.clear()
+        if self._events is not None:
+            self._events.drain()
+            logging.debug("events of %s: %r" % (self.name,
+                                                self._events.stats()))
         for action in self.actions:
             action.end_run()
 
@@ -1,5 +1,9 @@
+import atexit
+import logging
 import smtplib
+import socket
 import string
+import threading
 import time
 
 from timyd import Action
@@ -22,17 +26,182 @@ class MailSender(object):
                 '',
                 body),
                 '\r\n')
-        if self._server is None:
-            self._server = smtplib.SMTP(options['smtp_host'],
-                                       options.get('smtp_port', 25))
+        if self._server is not None:
+            try:
+                self._server.sendmail(self._from_addr, to, data)
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # The server closed the connection we kept; reconnect
+                self._server = None
+        self._server = smtplib.SMTP(options['smtp_host'],
+                                    options.get('smtp_port', 25))
         self._server.sendmail(self._from_addr, to, data)
 
     def quit(self):
         if self._server is not None:
-            self._server.quit()
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
             self._server = None
 
 
+class MailQueue(object):
+    """Sends mails from a background thread, so the checks don't wait.
+
+    Mails are sent when flush() is called (at the end of a run), or after
+    the 'max_delay' option of the oldest one (default: 30 seconds). The mails
+    sent together to the same recipients are merged into a single digest.
+    The SMTP connections are kept open for 'keepalive' seconds.
+    """
+
+    def __init__(self, keepalive=60):
+        self.keepalive = keepalive
+        self._cond = threading.Condition()
+        self._mails = [] # [(deadline, to, subject, body, options)]
+        self._flush = False
+        self._stopping = False
+        self._thread = None
+        self._senders = dict() # (host, port, sender) -> MailSender
+        self._last_sent = None
+
+    def put(self, to, subject, body, **options):
+        if isinstance(to, (list, tuple)):
+            to = tuple(to)
+        else:
+            to = (to,)
+        deadline = time.time() + options.get('max_delay', 30)
+        with self._cond:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run,
+                                                name='timyd-mails')
+                self._thread.daemon = True
+                self._thread.start()
+            self._mails.append((deadline, to, subject, body, options))
+            self._cond.notify()
+
+    def flush(self):
+        """Sends the queued mails now, without waiting for them.
+        """
+        with self._cond:
+            # Only about these mails; the next ones wait for their delay
+            if self._mails:
+                self._flush = True
+                self._cond.notify()
+
+    def stop(self, timeout=None):
+        """Sends the queued mails and waits for the thread to exit.
+        """
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+            self._cond.notify()
+        thread.join(timeout)
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while True:
+                        now = time.time()
+                        if self._mails and (
+                                self._flush or self._stopping or
+                                now >= min(m[0] for m in self._mails)):
+                            break
+                        if self._stopping:
+                            self._thread = None
+                            self._close_senders()
+                            return
+                        if (self._senders and
+                                now >= self._last_sent + self.keepalive):
+                            self._close_senders()
+                        if self._mails:
+                            timeout = min(m[0] for m in self._mails) - now
+                        elif self._senders:
+                            timeout = self._last_sent + self.keepalive - now
+                        else:
+                            timeout = None
+                        self._cond.wait(timeout)
+                    mails, self._mails = self._mails, []
+                    self._flush = False
+                self._send(mails)
+        finally:
+            # If the thread dies, the next put() starts another one
+            with self._cond:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _send(self, mails):
+        # Merges the mails with the same recipients and server
+        groups = dict() # (host, port, sender, to) -> [(subject, body)]
+        order = []
+        for deadline, to, subject, body, options in mails:
+            try:
+                key = (options['smtp_host'], options.get('smtp_port', 25),
+                       options.get('sender'), to)
+                if key not in groups:
+                    groups[key] = []
+                    order.append((key, options))
+                groups[key].append((subject, body))
+            except Exception:
+                logging.exception("Couldn't send mail to %s" % ', '.join(to))
+
+        for key, options in order:
+            host, port, from_addr, to = key
+            subject, body = _digest(groups[key])
+            sender = self._senders.get(key[:3])
+            try:
+                if sender is None:
+                    sender = self._senders[key[:3]] = MailSender(**options)
+                sender.send_mail(list(to), subject, body, **options)
+            except Exception:
+                logging.exception("Couldn't send mail to %s" % ', '.join(to))
+                if sender is not None:
+                    sender.quit()
+        self._last_sent = time.time()
+
+    def _close_senders(self):
+        for sender in self._senders.itervalues():
+            sender.quit()
+        self._senders = dict()
+
+
+def _digest(mails):
+    """Merges several (subject, body) into one.
+    """
+    if len(mails) == 1:
+        return mails[0]
+    subject = '[timyd] %d alerts' % len(mails)
+    body = '\n\n'.join('%s\n%s\n%s' % (s, '-' * len(s), b)
+                        for s, b in mails)
+    return subject, body
+
+
+_mail_queue = None
+_mail_queue_lock = threading.Lock()
+
+
+def get_mail_queue():
+    """Returns the MailQueue shared by all the actions.
+    """
+    global _mail_queue
+    with _mail_queue_lock:
+        if _mail_queue is None:
+            _mail_queue = MailQueue()
+        return _mail_queue
+
+
+@atexit.register
+def send_queued_mails():
+    """Delivers the mails still in the queue before the program exits.
+    """
+    if _mail_queue is not None:
+        _mail_queue.stop(60)
+
+
 class MailAlertAction(Action):
     """Sends an alert when a service's status changes.
     """
@@ -47,7 +216,7 @@ class MailAlertAction(Action):
     def __init__(self, recipients, **options):
         self._recipients = recipients
         self._options = options
-        self._sender = MailSender(**options)
+        self._queue = get_mail_queue()
 
     def register_status_change(self, site, service, old_status, new_status):
         if old_status is None:
@@ -70,11 +239,11 @@ class MailAlertAction(Action):
             body = self._DEFAULT_BODY.format(**infos)
         elif isinstance(body, dict):
             body = body[new_status]
-        self._sender.send_mail(
+        self._queue.put(
                 self._recipients,
                 subject,
                 body,
                 **self._options)
 
     def end_run(self):
-        self._sender.quit()
+        self._queue.flush()
@@ -1,4 +1,6 @@
+import json
 import sys
+import time
 
 from timyd import Action
 from timyd.console import colors
@@ -11,32 +13,130 @@ def format_status(status):
         return colors.red(status)
 
 
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
 class TextOutput(Action):
     """Displays the result of the service checks on the terminal.
+
+    mode is one of:
+     - 'text': a line for each check, warning and property change;
+     - 'table': a compact table of the checks, with a column per field,
+       sized for the whole run (so flush_every can't be used);
+     - 'json': a JSON object per line for each event, for other programs.
+    In text mode, each event is written as it happens, unless flush_every
+    is given. Otherwise, the output is buffered, and written at the end of
+    the run, or every flush_every events if given.
     """
 
+    MODES = ('text', 'table', 'json')
+
+    def __init__(self, mode='text', stream=None, flush_every=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown output mode %r" % (mode,))
+        if mode == 'table' and flush_every:
+            raise ValueError("flush_every can't be used in table mode")
+        self._mode = mode
+        self._stream = stream
+        self._flush_every = flush_every
+        self._buffered = mode != 'text' or bool(flush_every)
+        self._buffer = [] # strings, or rows in table mode
+        self._events = 0
+
+    def _add(self, item):
+        self._buffer.append(item)
+        self._events += 1
+        if not self._buffered or (self._flush_every and
+                                  self._events >= self._flush_every):
+            self.flush()
+
+    def _add_json(self, event, site, service, **fields):
+        fields.update(event=event, time=time.time(),
+                      site=site, service=service)
+        self._add(json.dumps(fields, sort_keys=True) + '\n')
+
     def register_property_change(self, site, service, name,
             old_value, new_value):
-        sys.stdout.write(colors.yellow(
-                "[property change] %s.%s: %s: %s" % (
-                site, service, name, new_value)))
-        if old_value is not None:
-            sys.stdout.write(" (was %s)\n" % old_value)
+        if self._mode == 'json':
+            self._add_json('property', site, service, name=name,
+                           old_value=_text(old_value),
+                           new_value=_text(new_value))
+        elif self._mode == 'table':
+            self._add(('%s.%s' % (site, service), colors.yellow,
+                       '%s: %s' % (name, new_value),
+                       '' if old_value is None else '%s' % (old_value,),
+                       ''))
         else:
-            sys.stdout.write("\n")
+            line = "[property change] %s.%s: %s: %s" % (
+                    site, service, name, new_value)
+            if old_value is not None:
+                self._add(colors.yellow(line) + " (was %s)\n" % old_value)
+            else:
+                self._add(colors.yellow(line) + "\n")
 
     def register_service_check(self, site, service, old_status, status, error,
             warnings):
-        for w in warnings:
-            sys.stdout.write(colors.cyan(
-                    "[warning] %s: %s\n" % (
-                    w[0], w[1])))
+        if self._mode == 'json':
+            self._add_json('check', site, service,
+                           status=status, old_status=old_status,
+                           error=None if error is None else _text(str(error)),
+                           warnings=[[_text(n), _text(m)]
+                                     for n, m in warnings])
+            return
+        elif self._mode == 'table':
+            self._add(('%s.%s' % (site, service), None,
+                       status or 'OK',
+                       '' if old_status in (None, status)
+                       else old_status or 'OK',
+                       '; '.join(m for n, m in warnings)))
+            return
 
+        lines = [colors.cyan("[warning] %s: %s\n" % (w[0], w[1]))
+                 for w in warnings]
         color = colors.yellow if status != old_status else colors.white
-        sys.stdout.write(color(
-                "[service check] %s.%s: %s" % (
-                site, service, format_status(status))))
+        line = color("[service check] %s.%s: %s" % (
+                site, service, format_status(status)))
         if old_status is not None:
-            sys.stdout.write(" (was %s)\n" % format_status(old_status))
+            lines.append(line + " (was %s)\n" % format_status(old_status))
         else:
-            sys.stdout.write("\n")
+            lines.append(line + "\n")
+        self._add(''.join(lines))
+
+    def _render_table(self, rows):
+        widths = [max(len(row[i]) for row in rows) for i in (0, 2, 3)]
+        lines = []
+        for name, color, status, old_status, warnings in rows:
+            cells = [name.ljust(widths[0]), status.ljust(widths[1]),
+                     old_status.ljust(widths[2])]
+            if color is not None:
+                cells[1] = color(cells[1])
+            elif status != 'OK':
+                cells[1] = colors.red(cells[1])
+            else:
+                cells[1] = colors.blue(cells[1])
+            if old_status:
+                cells[0] = colors.yellow(cells[0])
+            lines.append(('  '.join(cells) + '  ' + warnings).rstrip() +
+                         '\n')
+        return ''.join(lines)
+
+    def flush(self):
+        """Writes the buffered output at once.
+        """
+        if not self._buffer:
+            return
+        if self._mode == 'table':
+            data = self._render_table(self._buffer)
+        else:
+            data = ''.join(self._buffer)
+        self._buffer = []
+        self._events = 0
+        stream = self._stream or sys.stdout
+        stream.write(data)
+        stream.flush()
+
+    def end_run(self):
+        self.flush()
@@ -0,0 +1,231 @@
+"""Benchmarks of the BinaryLog engine.
+
+Run with:
+    python -m timyd.bench [options]
+
+A synthetic log is generated with the given number of properties and length
+of history, then the usual operations are timed. The results are printed as
+JSON, so they can be compared across versions.
+"""
+
+from optparse import OptionParser
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+from timyd.logged_properties import BinaryLog
+
+
+def _rate(count, elapsed):
+    if elapsed <= 0:
+        return None
+    return count / elapsed
+
+
+def generate(filename, properties, history, runs, **options):
+    """Writes a synthetic log, as would 'runs' runs of a check.
+
+    Every property changes 'history' times, as 'runs' batches. Returns the
+    time spent in set_property() and the number of changes.
+    """
+    names = ['property_%d' % i for i in xrange(properties)]
+    per_run = max(1, history // runs)
+    t = 1000000000
+    changes = 0
+    elapsed = 0.0
+    done = 0
+    while done < history:
+        count = min(per_run, history - done)
+        with BinaryLog(filename, **options) as log:
+            start = timer()
+            with log.batch():
+                for i in xrange(count):
+                    t += 60
+                    for j, name in enumerate(names):
+                        if j % 2:
+                            log.set_property(name, done + i, t=t)
+                        else:
+                            log.set_property(name, 'value %d' % (done + i),
+                                             t=t)
+            elapsed += timer() - start
+        changes += count * len(names)
+        done += count
+    return elapsed, changes, names, t
+
+
+def bench(properties=20, history=1000, runs=10, repeat=100, seed=0,
+          version=None, property_ids=False, use_mmap=True,
+          index_interval=None, journal=False, directory=None):
+    """Runs all the benchmarks, returning a dict of results.
+    """
+    random.seed(seed)
+    tmpdir = tempfile.mkdtemp(prefix='timyd_bench_', dir=directory)
+    try:
+        filename = os.path.join(tmpdir, 'bench.binlog')
+        write_options = dict(version=version, property_ids=property_ids,
+                             index_interval=index_interval, journal=journal)
+        read_options = dict(readonly=True, use_mmap=use_mmap)
+        results = dict()
+
+        # set_property()
+        elapsed, changes, names, last_time = generate(
+                filename, properties, history, runs, **write_options)
+        results['set_property_ops_per_sec'] = _rate(changes, elapsed)
+        size = os.path.getsize(filename)
+        results['file_size'] = size
+        results['bytes_per_change'] = float(size) / changes
+
+        # Unbatched set_property()
+        with BinaryLog(filename, journal=journal) as log:
+            start = timer()
+            for i in xrange(repeat):
+                last_time += 60
+                log.set_property(names[i % len(names)], i, t=last_time)
+            elapsed = timer() - start
+        results['unbatched_set_property_ops_per_sec'] = _rate(repeat,
+                                                              elapsed)
+
+        # Opening
+        start = timer()
+        for i in xrange(repeat):
+            BinaryLog(filename, **read_options).close()
+        results['open_readonly_ms'] = (timer() - start) * 1000.0 / repeat
+        start = timer()
+        for i in xrange(repeat):
+            with BinaryLog(filename, lazy=True, **read_options) as log:
+                log.get_property(names[0])
+        results['open_lazy_get_ms'] = (timer() - start) * 1000.0 / repeat
+        start = timer()
+        for i in xrange(repeat):
+            BinaryLog(filename).close()
+        results['open_close_writable_ms'] = ((timer() - start) * 1000.0 /
+                                             repeat)
+
+        with BinaryLog(filename, **read_options) as log:
+            # get_property()
+            lookups = [random.choice(names) for i in xrange(repeat * 10)]
+            start = timer()
+            for name in lookups:
+                log.get_property(name)
+            results['get_property_us'] = ((timer() - start) * 1000000.0 /
+                                          len(lookups))
+
+            # History scans
+            for dir, key in ((1, 'forward'), (-1, 'backward')):
+                records = 0
+                start = timer()
+                for name in names:
+                    for change in log.get_property_history(name, dir=dir):
+                        records += 1
+                elapsed = timer() - start
+                results['history_%s_records_per_sec' % key] = _rate(
+                        records, elapsed)
+
+            # Range queries
+            first_time = 1000000000
+            queries = [random.randint(first_time, last_time)
+                       for i in xrange(repeat)]
+            start = timer()
+            for i, t in enumerate(queries):
+                it = log.get_property_history(names[i % len(names)], t,
+                                              search=1)
+                for j, change in zip(xrange(10), it):
+                    pass
+            results['range_query_ms'] = ((timer() - start) * 1000.0 /
+                                         len(queries))
+
+        return {
+                'parameters': {
+                        'properties': properties,
+                        'history': history,
+                        'runs': runs,
+                        'repeat': repeat,
+                        'seed': seed,
+                        'version': version,
+                        'property_ids': property_ids,
+                        'use_mmap': use_mmap,
+                        'index_interval': index_interval,
+                        'journal': journal},
+                'results': results}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(args=None):
+    optparser = OptionParser(usage="python -m timyd.bench [options]")
+    optparser.add_option(
+            '-p', '--properties',
+            action='store', type='int', dest='properties',
+            help="number of properties (default: 20)")
+    optparser.add_option(
+            '-n', '--history',
+            action='store', type='int', dest='history',
+            help="number of changes of each property (default: 1000)")
+    optparser.add_option(
+            '-r', '--runs',
+            action='store', type='int', dest='runs',
+            help="number of runs the changes are written in (default: 10)")
+    optparser.add_option(
+            '--repeat',
+            action='store', type='int', dest='repeat',
+            help="number of repetitions of the timed operations "
+                 "(default: 100)")
+    optparser.add_option(
+            '--seed',
+            action='store', type='int', dest='seed',
+            help="random seed (default: 0)")
+    optparser.add_option(
+            '--format-version',
+            action='store', type='int', dest='version',
+            help="version of the log format (default: latest)")
+    optparser.add_option(
+            '--property-ids',
+            action='store_true', dest='property_ids',
+            help="use property IDs in the records (BINLOG02)")
+    optparser.add_option(
+            '--no-mmap',
+            action='store_false', dest='use_mmap',
+            help="don't memory-map readonly logs")
+    optparser.add_option(
+            '--index-interval',
+            action='store', type='int', dest='index_interval',
+            help="keep a time index with an entry every N changes")
+    optparser.add_option(
+            '--journal',
+            action='store_true', dest='journal',
+            help="write the changes through a journal, syncing the log "
+                 "when closing it")
+    optparser.add_option(
+            '-d', '--dir',
+            action='store', dest='directory',
+            help="where to create the temporary log (default: system "
+                 "temporary directory)")
+    optparser.add_option(
+            '-o', '--output',
+            action='store', dest='output',
+            help="write the results to this file instead of stdout")
+    optparser.set_defaults(properties=20, history=1000, runs=10, repeat=100,
+                           seed=0, version=None, property_ids=False,
+                           use_mmap=True, index_interval=None,
+                           journal=False, directory=None, output=None)
+    (options, args) = optparser.parse_args(args)
+    options = vars(options)
+    output = options.pop('output')
+
+    results = bench(**options)
+    results['python'] = sys.version.split()[0]
+
+    if output is not None:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
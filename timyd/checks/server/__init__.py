@@ -1,5 +1,5 @@
 # Exceptions
-from .server import CantResolve, CantConnect, TimedOut
+from .server import CantResolve, CantConnect, TimedOut, InvalidResponse
 
 from .server import ServerService
 
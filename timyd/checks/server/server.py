@@ -1,7 +1,15 @@
+import collections
+import errno
+import inspect
+import math
 import socket
+import sys
 import time
 
-from timyd import Service, CheckFailure
+from timyd import Service, CheckFailure, SiteManager
+from timyd import eventloop
+from timyd.logged_properties import StringProperty
+from timyd.eventloop import Readable, Writable, InThread, Return, Future
 
 
 class CantResolve(CheckFailure):
@@ -33,41 +41,180 @@ class InvalidLine(CheckFailure):
         return "Line too long - wrong protocol or DoS attempt?"
 
 
+class InvalidResponse(CheckFailure):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class _LineBuffer(object):
+    """Receive buffer splitting a stream into lines, shared by the readers.
+
+    Data is received directly into a preallocated bytearray (with
+    recv_into()), and the search for the end of line resumes where the last
+    one stopped, so a long line arriving in many pieces is neither copied
+    nor scanned more than once. Lines are only copied out when complete.
+    """
+
+    def __init__(self, size=4096):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0 # first byte not consumed
+        self._scan = 0 # bytes before this position contain no newline
+        self._end = 0 # end of the received data
+        self._code = None # code of the response being read
+        self._lines = None # lines of the response being read
+
+    def buffered(self):
+        return self._end - self._start
+
+    def next_line(self, max):
+        """Returns the next line, or None if it has not been received yet.
+
+        Raises InvalidLine if it is longer than max bytes (terminator
+        included).
+        """
+        limit = min(self._end, self._start + max)
+        p = self._buf.find(b'\n', self._scan, limit)
+        if p < 0:
+            if limit - self._start >= max:
+                raise InvalidLine
+            self._scan = limit
+            return None
+        end = p
+        if end > self._start and self._buf[end - 1] == 13: # '\r'
+            end -= 1
+        line = self._view[self._start:end].tobytes()
+        self._start = self._scan = p + 1
+        if self._start == self._end:
+            self._start = self._scan = self._end = 0
+        return line
+
+    def next_response(self, max, max_lines):
+        """Returns the next response (code, lines) or None if incomplete.
+
+        Responses are SMTP/FTP style: each line starts with a 3-digit code,
+        followed by '-' if more lines follow or ' ' on the last line. Lines
+        in between that don't start with the code are kept whole (FTP allows
+        it). The lines are returned without the code.
+        """
+        while True:
+            line = self.next_line(max)
+            if line is None:
+                return None
+            code, sep = line[:3], line[3:4]
+            if self._code is None:
+                if not code.isdigit() or sep not in ('-', ' ', ''):
+                    raise InvalidResponse(
+                            u"Invalid response line: %r" % (line[:80],))
+                self._code = code
+                self._lines = []
+            elif len(self._lines) >= max_lines:
+                self._code = self._lines = None
+                raise InvalidResponse(u"Response is too long")
+            if code != self._code or sep not in ('-', ' ', ''):
+                self._lines.append(line)
+            elif sep == '-':
+                self._lines.append(line[4:])
+            else:
+                response = int(code), self._lines + [line[4:]]
+                self._code = self._lines = None
+                return response
+
+    def rest(self):
+        """Returns all the buffered data, for when the stream is closed.
+        """
+        data = self._view[self._start:self._end].tobytes()
+        self._start = self._scan = self._end = 0
+        return data
+
+    def space(self, max):
+        """Returns a writable view to receive into, for lines up to max.
+        """
+        length = self.buffered()
+        if len(self._buf) < max:
+            buf = bytearray(max)
+            buf[:length] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        elif self._start > 0 and self._end == len(self._buf):
+            # Moves the pending data to the front
+            self._buf[:length] = self._buf[self._start:self._end]
+        else:
+            return self._view[self._end:]
+        self._scan -= self._start
+        self._start, self._end = 0, length
+        return self._view[self._end:]
+
+    def received(self, nbytes):
+        self._end += nbytes
+
+
+def _response_eof():
+    raise InvalidResponse(u"Connection closed while reading a response")
+
+
 class LineReader(object):
     """Wrapper for a socket allowing to read one line at a time.
     """
 
     def __init__(self, sock):
         self._sock = sock
-        self._buf = ''
+        self._buf = _LineBuffer()
 
     def settimeout(self, tm):
         self._sock.settimeout(tm)
 
-    def read_line(self, max):
+    def _read(self, next, max, eof):
         start = time.time()
         tm = self._sock.gettimeout()
-        p = self._buf.find('\n')
-        if p >= 0:
-            l = self._buf[:p]
-            if l[-1] == '\r':
-                l = l[:-1]
-            return l
-        while len(self._buf) < max:
-            data = self._sock.recv(max - len(self._buf))
-            p = data.find('\n')
-            if p >= 0:
-                l = self._buf + data[:p]
-                self._buf = data[p+1:]
-                if l[-1] == '\r':
-                    l = l[:-1]
-                return l
-            self._buf += data
+        while True:
+            result = next()
+            if result is not None:
+                return result
+            space = self._buf.space(max)
+            try:
+                nbytes = self._sock.recv_into(space, len(space))
+            except socket.timeout:
+                raise TimedOut(u"Timed out while reading after %fs" %
+                        (time.time() - start))
+            if not nbytes: # connection closed
+                return eof()
+            self._buf.received(nbytes)
             now = time.time()
             if tm and now - start > tm:
-                raise TimedOut(u"Timed out while reading a line after %fs" %
+                raise TimedOut(u"Timed out while reading after %fs" %
                         (now - start))
-        raise InvalidLine
+
+    def read_line(self, max):
+        return self._read(lambda: self._buf.next_line(max), max,
+                          self._buf.rest)
+
+    def read_response(self, max=512, max_lines=100):
+        """Reads a whole multi-line response, returning (code, lines).
+
+        max is the maximum length of each line.
+        """
+        return self._read(lambda: self._buf.next_response(max, max_lines),
+                          max, _response_eof)
+
+    def read_responses(self, count, max=512, max_lines=100):
+        """Reads the responses to 'count' pipelined commands.
+        """
+        responses = []
+        for i in xrange(count):
+            responses.append(self.read_response(max, max_lines))
+        return responses
+
+    def send_commands(self, commands):
+        """Sends several commands at once, without waiting for replies.
+
+        Only do this where the protocol allows it (eg SMTP PIPELINING);
+        read the replies with read_responses(len(commands)).
+        """
+        self._sock.sendall(''.join(commands))
 
     def send(self, data):
         self._sock.send(data)
@@ -76,6 +223,129 @@ class LineReader(object):
         self._sock.close()
 
 
+class AsyncLineReader(object):
+    """Non-blocking version of LineReader, for use in coroutines.
+
+    The read and send methods are coroutines, that should be yielded:
+        line = yield reader.read_line(512)
+        code, lines = yield reader.read_response()
+    """
+
+    def __init__(self, sock, timeout=None):
+        self._sock = sock
+        self._sock.setblocking(0)
+        self._timeout = timeout
+        self._buf = _LineBuffer()
+
+    def settimeout(self, tm):
+        self._timeout = tm
+
+    def _read(self, next, max, eof):
+        start = time.time()
+        while True:
+            result = next()
+            if result is not None:
+                raise Return(result)
+            if self._timeout is not None:
+                remaining = start + self._timeout - time.time()
+                if remaining <= 0:
+                    raise TimedOut(
+                            u"Timed out while reading after %fs" %
+                            (time.time() - start))
+            else:
+                remaining = None
+            try:
+                yield Readable(self._sock, remaining)
+            except socket.timeout:
+                continue
+            space = self._buf.space(max)
+            try:
+                nbytes = self._sock.recv_into(space, len(space))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+            if not nbytes: # connection closed
+                raise Return(eof())
+            self._buf.received(nbytes)
+
+    def read_line(self, max):
+        return self._read(lambda: self._buf.next_line(max), max,
+                          self._buf.rest)
+
+    def read_response(self, max=512, max_lines=100):
+        """Reads a whole multi-line response, returning (code, lines).
+        """
+        return self._read(lambda: self._buf.next_response(max, max_lines),
+                          max, _response_eof)
+
+    def read_responses(self, count, max=512, max_lines=100):
+        """Reads the responses to 'count' pipelined commands.
+        """
+        responses = []
+        for i in xrange(count):
+            response = yield self.read_response(max, max_lines)
+            responses.append(response)
+        raise Return(responses)
+
+    def send_commands(self, commands):
+        """Sends several commands at once, without waiting for replies.
+        """
+        return self.send(''.join(commands))
+
+    def send(self, data):
+        while data:
+            yield Writable(self._sock, self._timeout)
+            try:
+                sent = self._sock.send(data)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                raise
+            data = data[sent:]
+
+    def close(self):
+        self._sock.close()
+
+
+def _format_address(sockaddr):
+    if ':' in sockaddr[0]:
+        return '[%s]:%d' % sockaddr[:2]
+    return '%s:%d' % sockaddr[:2]
+
+
+def _run_blocking(task):
+    """Runs a connected_check() coroutine with a blocking LineReader.
+
+    The LineReader methods return their results directly, so what the
+    coroutine yields is sent back into it; sub-generators are run the same
+    way.
+    """
+    value = exc_info = None
+    while True:
+        try:
+            if exc_info is not None:
+                item = task.throw(*exc_info)
+            else:
+                item = task.send(value)
+        except StopIteration:
+            return None
+        except Return, r:
+            return r.value
+        value = exc_info = None
+        if inspect.isgenerator(item):
+            try:
+                value = _run_blocking(item)
+            except:
+                exc_info = sys.exc_info()
+        else:
+            value = item
+
+
+# Outcomes of connect_staggered() that don't tell whether the address works
+_TRANSIENT_OUTCOMES = ('timeout', 'abandoned', 'untried')
+
+
 class ServerService(Service):
     """A generic server.
 
@@ -83,48 +353,272 @@ class ServerService(Service):
     that connect to a server.
     """
 
+    # Reachability of the addresses of the server, eg
+    # "[2001:db8::1]:25 ENETUNREACH, 192.0.2.1:25 connected". The transient
+    # outcomes are left out, so that the property (and the actions) only
+    # change when an address starts or stops working; the addresses that
+    # timed out are counted in the 'timeout_addresses' metric
+    addresses = StringProperty('addresses')
+
+    # Delay before trying the next address if the previous one hasn't
+    # connected yet
+    connect_delay = 0.25
+
+    # The latencies of the steps of the check are recorded (in ms) in the
+    # '<step>_latency' metrics. The timeouts are timeout_factor times their
+    # usual value (the latency_percentile of the last latency_history
+    # checks), within min_timeout and max_timeout; a latency is abnormal
+    # above warning_factor times the usual value. Until there are
+    # min_latency_samples, max_timeout and default_warning are used.
+    latency_history = 50
+    min_latency_samples = 10
+    latency_percentile = 0.95
+    timeout_factor = 4
+    min_timeout = 1.0
+    max_timeout = 10.0
+    warning_factor = 2
+    default_warning = 2.0
+
+    # With share_probes, the services with the same probe_key() share a
+    # single probe per run; the Site keeps them until the end of the run
+    share_probes = False
+
     def __init__(self, name, address, port):
         Service.__init__(self, name)
         self.address = address
         self.port = port
+        self._probe = None # Future of the probe this service is doing
+        self._recording = None
+        self._latencies = dict()
+        # step -> deque of the last latency_history latencies (in ms), read
+        # from the log once then kept up to date by record_metric()
+        self._latency_history = dict()
+
+    def probe_key(self):
+        """Identifies the probe done by check(), or None to always probe.
+
+        Services of a site that set share_probes and have the same key get
+        the same result, so the server is only connected to once per run:
+        the first one to be checked does the probe, and the properties it
+        set, its warnings and its error are replayed on the others.
+        Subclasses whose checks depend on other parameters must add them to
+        the key.
+        """
+        if not self.share_probes:
+            return None
+        return (type(self), self.address, self.port)
 
     def check(self):
-        try:
-            addresses = socket.getaddrinfo(
-                    self.address, self.port,
-                    socket.AF_UNSPEC, socket.SOCK_STREAM)
-        except socket.gaierror:
-            raise CantResolve(self.address)
-        if not addresses:
-            raise CantResolve(self.address)
-        elif len(addresses) > 1:
-            self.warning("Multiple addresses available for %s:%d" % (
-                    self.address, self.port))
+        task = self.check_task()
+        if task is not None:
+            eventloop.run(task)
+            return
 
-        for info in addresses:
-            af, socktype, proto, canonname, sa = info
-            try:
-                s = socket.socket(af, socktype, proto)
-            except socket.error, e:
-                continue
-            s.settimeout(10)
-            try:
-                self.check_start = time.time()
-                s.connect(sa)
-            except socket.error, e:
-                s.close()
-                continue
+        probe = self._join_probe()
+        if probe is not None:
+            self._replay(probe.result())
+            return
+        self._recording = []
+        try:
+            s, info = eventloop.run(self._connect())
+            s.setblocking(1)
+            s.settimeout(self.get_timeout('banner'))
             reader = LineReader(s)
             try:
-                self.connected_check(reader, info)
+                task = self.connected_check(reader, info)
+                if inspect.isgenerator(task):
+                    _run_blocking(task)
+            except TimedOut:
+                self._record_timeout('banner', s.gettimeout())
+                raise
             finally:
                 reader.close()
+        except:
+            self._probe_done(sys.exc_info())
+            raise
+        self._probe_done(None)
+
+    def hostnames(self):
+        return (self.address,)
+
+    def check_task(self):
+        """Coroutine version of check(), used if connected_check() is one.
+
+        Subclasses that override check() are run through it instead.
+        """
+        if type(self).check.im_func is not ServerService.check.im_func:
+            return None
+        connected_check = self.connected_check.im_func
+        if (connected_check is not ServerService.connected_check.im_func and
+                not inspect.isgeneratorfunction(connected_check)):
+            return None
+        return self._check_task()
+
+    def _check_task(self):
+        probe = self._join_probe()
+        if probe is not None:
+            result = yield probe
+            self._replay(result)
             return
-        raise CantConnect(self.address, self.port)
+        self._recording = []
+        try:
+            s, info = yield self._connect()
+            timeout = self.get_timeout('banner')
+            reader = AsyncLineReader(s, timeout)
+            try:
+                task = self.connected_check(reader, info)
+                if task is not None:
+                    yield task
+            except TimedOut:
+                self._record_timeout('banner', timeout)
+                raise
+            finally:
+                reader.close()
+        except:
+            self._probe_done(sys.exc_info())
+            raise
+        self._probe_done(None)
+
+    def _join_probe(self):
+        """Returns the Future of the probe if another service is doing it.
+
+        Otherwise, returns None and this service has to do the probe.
+        """
+        key = self.probe_key()
+        if key is None:
+            return None
+        with self.site.probes_lock:
+            probe = self.site.probes.get(key)
+            if probe is not None:
+                return probe
+            self._probe = self.site.probes[key] = Future()
+        return None
+
+    def _probe_done(self, exc_info):
+        properties, self._recording = self._recording, None
+        probe, self._probe = self._probe, None
+        if probe is not None:
+            probe.set_result((properties, list(self._warnings), exc_info))
+
+    def _replay(self, result):
+        properties, warnings, exc_info = result
+        for prop, value, metric in properties:
+            if metric:
+                self.record_metric(prop, value)
+            else:
+                self.set_property(prop, value)
+        for name, msg in warnings:
+            self.warning(name, msg)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def set_property(self, prop, value):
+        if self._recording is not None:
+            self._recording.append((prop, value, False))
+        Service.set_property(self, prop, value)
+
+    def record_metric(self, prop, value):
+        if self._recording is not None:
+            self._recording.append((prop, value, True))
+        if prop.endswith('_latency'):
+            history = self._latency_history.get(prop[:-len('_latency')])
+            if history is not None:
+                history.append(value)
+        Service.record_metric(self, prop, value)
+
+    def _usual_latency(self, step):
+        """Returns the usual latency of a step in seconds, or None.
+        """
+        history = self._latency_history.get(step)
+        if history is None:
+            history = collections.deque(
+                    reversed(self.get_metric_history('%s_latency' % step,
+                                                     self.latency_history)),
+                    maxlen=self.latency_history)
+            self._latency_history[step] = history
+        if len(history) < self.min_latency_samples:
+            return None
+        history = sorted(history)
+        i = int(math.ceil(len(history) * self.latency_percentile)) - 1
+        return history[max(0, i)] / 1000.0
+
+    def get_timeout(self, step):
+        """Returns the timeout for a step of the check, eg 'connect'.
+        """
+        usual = self._usual_latency(step)
+        if usual is None:
+            return self.max_timeout
+        return min(self.max_timeout,
+                   max(self.min_timeout, usual * self.timeout_factor))
+
+    def record_latency(self, step, seconds):
+        """Records the latency of a step of the check, eg 'banner'.
+
+        Returns True if it is abnormally high, so the check can warn.
+        """
+        usual = self._usual_latency(step)
+        if usual is None:
+            threshold = self.default_warning
+        else:
+            threshold = usual * self.warning_factor
+        self._latencies[step] = seconds
+        self.record_metric('%s_latency' % step, int(seconds * 1000))
+        return seconds > threshold
+
+    def _record_timeout(self, step, timeout):
+        # Without this, a server that became slower would keep timing out,
+        # as the timeout only follows the latencies that were recorded
+        if step not in self._latencies:
+            self.record_latency(step, timeout)
+
+    def _connect(self):
+        """Coroutine resolving the server and connecting to it.
+
+        All the addresses are tried, with staggered attempts (see
+        eventloop.connect_staggered()). The outcome for each one is recorded
+        in the 'addresses' property, unless it is transient.
+        """
+        try:
+            addresses = yield InThread(
+                    SiteManager.resolver.getaddrinfo,
+                    self.address, self.port)
+        except socket.gaierror:
+            raise CantResolve(self.address)
+        if not addresses:
+            raise CantResolve(self.address)
+
+        self._latencies = dict()
+        self.check_start = time.time()
+        timeout = self.get_timeout('connect')
+        s, info, outcomes = yield eventloop.connect_staggered(
+                addresses, self.connect_delay, timeout)
+        self.connect_time = time.time()
+        self.addresses = ', '.join('%s %s' % (_format_address(i[4]), outcome)
+                                   for i, outcome in outcomes
+                                   if outcome not in _TRANSIENT_OUTCOMES)
+        self.record_metric('timeout_addresses',
+                           sum(1 for i, outcome in outcomes
+                               if outcome == 'timeout'))
+        if s is None:
+            if any(outcome == 'timeout' for i, outcome in outcomes):
+                self._record_timeout('connect', timeout)
+            raise CantConnect(self.address, self.port)
+        self.record_latency('connect', self.connect_time - self.check_start)
+        raise Return((s, info))
 
     def connected_check(self, s, addrinfo):
         """Default version of connected_check() does nothing.
 
         If we could establish a connection, the test passes. Override this
         method to provide protocol-specific tests.
+
+        If connected_check() is a generator, it is run as a coroutine and
+        receives an AsyncLineReader; many such checks can then run on a
+        single EventLoop. Otherwise it receives a blocking LineReader.
+
+        The connected_check() of SSHService and SMTPService are generators.
+        A subclass overriding it with a normal method can still use them by
+        returning their result: a generator returned with a blocking
+        LineReader is run to completion, the reader's results being sent
+        back into it.
         """
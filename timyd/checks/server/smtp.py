@@ -4,7 +4,7 @@ import time
 from timyd import Service, CheckFailure
 from timyd.logged_properties import StringProperty
 
-from .server import ServerService
+from .server import ServerService, InvalidResponse
 
 
 class SMTPService(ServerService):
@@ -26,21 +26,36 @@ class SMTPService(ServerService):
         self.rcpt = rcpt
         self.from_host = from_host
 
+    def probe_key(self):
+        key = ServerService.probe_key(self)
+        if key is None:
+            return None
+        return key + (self.rcpt, self.from_host)
+
     def connected_check(self, s, addrinfo):
-        banner = s.read_line(512)
-        t = time.time() - self.check_start
-        if banner is None or banner == '':
+        # The greeting can span several lines
+        try:
+            code, lines = yield s.read_response(512)
+        except InvalidResponse:
             raise SMTPService.ProtocolMismatch("Unable to read SMTP banner")
-        if not banner.startswith("220 "):
+        t = time.time() - self.connect_time
+        if code != 220:
             raise SMTPService.ProtocolMismatch(
                     "Server did not send 220 banner")
-        self.banner = banner
-        if t > 2:
+        self.banner = "220 %s" % lines[0]
+        if self.record_latency('banner', t):
             self.warning(
                     'ping',
                     "Reception of the banner took %f seconds" % (t,))
         if self.rcpt:
-            s.send("EHLO %s\r\n" % self.from_host)
+            yield s.send("EHLO %s\r\n" % self.from_host)
+            code, lines = yield s.read_response(512)
+            if code != 250:
+                raise SMTPService.ProtocolMismatch(
+                        "Server replied %d to EHLO: %s" % (
+                        code, ' '.join(lines)))
             # TODO : attempt to send a message, check it is accepted
-            # (stop before DATA)
-        s.send("QUIT\r\n")
+            # (stop before DATA). MAIL FROM and RCPT TO can then be
+            # pipelined if 'PIPELINING' is in lines[1:]; EHLO and QUIT can't
+            # (RFC 2920, section 3.1)
+        yield s.send("QUIT\r\n")
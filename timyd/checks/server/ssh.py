@@ -24,12 +24,12 @@ class SSHService(ServerService):
         ServerService.__init__(self, name, address, port)
 
     def connected_check(self, s, addrinfo):
-        banner = s.read_line(512)
-        t = time.time() - self.check_start
+        banner = yield s.read_line(512)
+        t = time.time() - self.connect_time
         if banner is None or banner == '':
             raise SSHService.ProtocolMismatch("Unable to read SSH banner")
         self.banner = banner
-        if t > 2:
+        if self.record_latency('banner', t):
             self.warning(
                     'ping',
                     "Reception of the banner took %f seconds" % (t,))
@@ -0,0 +1,89 @@
+import heapq
+import logging
+import random
+import time
+
+from timyd import SiteManager
+
+
+class Scheduler(object):
+    """Runs the checks of a site forever, each one on its own interval.
+
+    The site stays loaded and the logs stay open between the runs. The
+    interval of a service is its 'interval' attribute (see Site.add_check()),
+    or the default interval. A random jitter of up to 'jitter' times the
+    interval is added, so that checks started together drift apart.
+
+    When a service is due, its dependencies are checked along with it; they
+    are then rescheduled as if they had been due.
+    """
+
+    def __init__(self, runner, interval=60, jitter=0.1):
+        self.runner = runner
+        self.interval = interval
+        self.jitter = jitter
+        self._heap = [] # [(time, service name)]
+        self._next = dict() # service name -> time
+        self._stopped = False
+
+    def get_interval(self, service):
+        if service.interval is not None:
+            return service.interval
+        return self.interval
+
+    def _schedule(self, service, now):
+        interval = self.get_interval(service)
+        when = now + interval * (1 + random.uniform(-self.jitter,
+                                                    self.jitter))
+        self._next[service.name] = when
+        heapq.heappush(self._heap, (when, service.name))
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, name = heapq.heappop(self._heap)
+            if self._next.get(name) == when: # else, rescheduled since
+                due.append(name)
+                del self._next[name]
+        return due
+
+    def stop(self, *args):
+        self._stopped = True
+
+    def run_forever(self):
+        due = self.runner.site.services.keys()
+        try:
+            while not self._stopped:
+                if due:
+                    self._run(due)
+                if self._stopped:
+                    break
+                now = time.time()
+                due = self._pop_due(now)
+                if not due:
+                    if self._heap:
+                        delay = self._heap[0][0] - now
+                    else:
+                        delay = self.interval
+                    time.sleep(max(0.0, min(delay, 60.0)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logging.info("Stopping daemon")
+            SiteManager.close_logs()
+
+    def _run(self, names):
+        logging.info("Running %d checks" % len(names))
+        try:
+            self.runner.check_services(names)
+        except Exception:
+            logging.exception("Error running checks")
+        self.runner.end_run()
+
+        site = self.runner.site
+        now = time.time()
+        checked = set(s.name for s in self.runner._checked_services)
+        for name in checked | set(names):
+            service = site.services.get(name)
+            if service is not None:
+                self._schedule(service, now)
@@ -0,0 +1,96 @@
+import logging
+import Queue
+import threading
+import time
+
+
+class EventQueue(object):
+    """Delivers the events of a site to its actions, from another thread.
+
+    The checks only put a small record in a bounded queue; a single consumer
+    thread calls the actions, in the order the events were produced (so the
+    events of each service arrive in order). If the actions fall behind and
+    the queue is full, the checks wait: stats() tells how often and for how
+    long.
+    """
+
+    def __init__(self, site, maxsize=1024):
+        self._site = site
+        self._queue = Queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {
+                'queued': 0, # events put in the queue
+                'delivered': 0, # events delivered to all the actions
+                'errors': 0, # exceptions raised by actions
+                'max_depth': 0, # largest number of events waiting
+                'blocked': 0, # number of times the queue was full
+                'blocked_time': 0.0} # seconds spent waiting on a full queue
+
+    def put(self, method, *args):
+        """Queues a call of method(site, *args) on each action.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                        target=self._run,
+                        name='timyd-events-%s' % self._site.name)
+                self._thread.daemon = True
+                self._thread.start()
+        event = (method, args)
+        try:
+            self._queue.put_nowait(event)
+        except Queue.Full:
+            start = time.time()
+            self._queue.put(event)
+            with self._lock:
+                self._stats['blocked'] += 1
+                self._stats['blocked_time'] += time.time() - start
+        depth = self._queue.qsize()
+        with self._lock:
+            self._stats['queued'] += 1
+            if depth > self._stats['max_depth']:
+                self._stats['max_depth'] = depth
+
+    def drain(self):
+        """Waits until all the queued events have been delivered.
+        """
+        self._queue.join()
+
+    def stop(self):
+        """Delivers the queued events and stops the thread.
+
+        The thread is started again by the next put().
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['depth'] = self._queue.qsize()
+        return stats
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                self._queue.task_done()
+                return
+            method, args = event
+            try:
+                for action in self._site.actions:
+                    try:
+                        getattr(action, method)(self._site.name, *args)
+                    except Exception:
+                        logging.exception("Error in action %s.%s" % (
+                                action.__class__.__name__, method))
+                        with self._lock:
+                            self._stats['errors'] += 1
+                with self._lock:
+                    self._stats['delivered'] += 1
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,590 @@
+"""A small event loop running checks as coroutines.
+
+Tasks are generators. A task yields what it is waiting for, and is resumed
+with the result (or has the exception thrown into it):
+ - another generator: it is run as a sub-task, its result is sent back;
+ - a Future: resumed once the future is done;
+ - Readable(sock, timeout) or Writable(sock, timeout): resumed once the socket
+   is ready; socket.timeout is raised if the timeout expires first;
+ - Select(rlist, wlist, timeout): resumed once any of the sockets is ready,
+   with the lists of ready sockets (empty if the timeout expired), like
+   select.select();
+ - Sleep(seconds);
+ - InThread(func, *args): func is called on the loop's executor, so that
+   blocking calls (eg getaddrinfo()) don't stall the other tasks.
+A generator returns a value by raising Return(value), as there is no 'return'
+with a value in generators.
+"""
+
+import errno
+import heapq
+import os
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+import types
+
+
+class Return(Exception):
+    """Raised by a coroutine to return a value to its caller.
+    """
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    """The result of a computation that might not have completed yet.
+
+    Futures can be completed from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exc_info):
+        """Completes the future with an exception.
+
+        exc_info is a tuple as returned by sys.exc_info().
+        """
+        self._complete(None, exc_info)
+
+    def _complete(self, result, exc_info):
+        with self._lock:
+            if self._event.is_set():
+                raise ValueError("Future is already done")
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = None
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) when the future is done.
+
+        The callback is called from the thread completing the future, or
+        immediately if it is already done.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exc_info(self):
+        return self._exc_info
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise socket.timeout("Future not done after %r seconds" % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class Readable(object):
+    def __init__(self, sock, timeout=None):
+        self.sock = sock
+        self.timeout = timeout
+
+
+class Writable(object):
+    def __init__(self, sock, timeout=None):
+        self.sock = sock
+        self.timeout = timeout
+
+
+class Select(object):
+    def __init__(self, rlist, wlist, timeout=None):
+        self.rlist = rlist
+        self.wlist = wlist
+        self.timeout = timeout
+
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class InThread(object):
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+
+class Executor(object):
+    """A pool of threads running blocking functions.
+    """
+
+    def __init__(self, threads, name='timyd-worker'):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in xrange(threads):
+            thread = threading.Thread(target=self._work,
+                                      name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            future, func, args, kwargs = job
+            try:
+                result = func(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+
+class _Task(object):
+    def __init__(self, gen):
+        self.stack = [gen]
+        self.future = Future()
+        self.waiting = None # token of the timer or socket it is waiting on
+        self.fds = [] # file descriptors it is waiting on
+
+
+class EventLoop(object):
+    """Runs coroutines, waiting on many sockets at once.
+
+    If no executor is given, InThread functions are simply called in the loop
+    thread.
+    """
+
+    def __init__(self, executor=None):
+        self._executor = executor
+        self._thread = None
+        self._ready = [] # [(_Task, value, exc_info)]
+        self._timers = [] # heap of (deadline, seq, _Task, token)
+        self._seq = 0
+        self._fds = dict() # fd -> (_Task, token, sock, kind)
+
+        # Callbacks scheduled from other threads, and the pipe used to wake
+        # the loop up
+        self._callbacks_lock = threading.Lock()
+        self._callbacks = []
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            _set_nonblocking(fd)
+
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+            self._poll.register(self._wake_r, select.POLLIN)
+        else:
+            self._poll = None
+
+    def close(self):
+        if self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
+
+    def spawn(self, gen):
+        """Schedules a coroutine, returning a Future for its result.
+        """
+        task = _Task(gen)
+        self._ready.append((task, None, None))
+        return task.future
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self._callbacks_lock:
+            self._callbacks.append((callback, args))
+        if threading.current_thread() is not self._thread:
+            try:
+                os.write(self._wake_w, b'x')
+            except OSError, e:
+                if e.errno != errno.EAGAIN: # pipe full: will wake up anyway
+                    raise
+
+    def run_until_complete(self, what):
+        """Runs the loop until a Future or a coroutine has completed.
+
+        Returns its result, or raises its exception.
+        """
+        if isinstance(what, types.GeneratorType):
+            what = self.spawn(what)
+        # Makes sure we don't go back to waiting once it is done
+        what.add_done_callback(
+                lambda f: self.call_soon_threadsafe(lambda: None))
+        self._thread = threading.current_thread()
+        try:
+            while not what.done():
+                self._run_once()
+        finally:
+            self._thread = None
+        return what.result()
+
+    def _run_once(self):
+        # Callbacks from other threads
+        if self._callbacks:
+            with self._callbacks_lock:
+                callbacks = self._callbacks
+                self._callbacks = []
+            for callback, args in callbacks:
+                callback(*args)
+
+        # Tasks that can go on
+        while self._ready:
+            ready = self._ready
+            self._ready = []
+            for task, value, exc_info in ready:
+                self._step(task, value, exc_info)
+        if self._callbacks:
+            return
+
+        # Wait for I/O or a timer
+        if self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+        else:
+            timeout = None
+        selected = dict() # Select -> (_Task, rlist, wlist)
+        for fd, events in self._wait(timeout):
+            if fd == self._wake_r:
+                try:
+                    while os.read(self._wake_r, 4096):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                continue
+            entry = self._fds.get(fd)
+            if entry is None:
+                continue
+            task, token, sock, kind = entry
+            if isinstance(token, Select):
+                task, rlist, wlist = selected.setdefault(token,
+                                                         (task, [], []))
+                (rlist if kind is Readable else wlist).append(sock)
+            else:
+                self._unwatch(task)
+                self._ready.append((task, None, None))
+        for task, rlist, wlist in selected.itervalues():
+            self._unwatch(task)
+            self._ready.append((task, (rlist, wlist), None))
+
+        # Expired timers
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, seq, task, token = heapq.heappop(self._timers)
+            if task.waiting is not token:
+                continue # cancelled
+            if isinstance(token, Sleep):
+                task.waiting = None
+                self._ready.append((task, None, None))
+            elif isinstance(token, Select):
+                self._unwatch(task)
+                self._ready.append((task, ([], []), None))
+            else:
+                self._unwatch(task)
+                self._ready.append((task, None, (
+                        socket.timeout,
+                        socket.timeout("timed out"),
+                        None)))
+
+    def _wait(self, timeout):
+        if self._poll is not None:
+            try:
+                return self._poll.poll(
+                        None if timeout is None else int(timeout * 1000) + 1)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+        rlist = [self._wake_r]
+        wlist = []
+        for fd, (task, token, sock, kind) in self._fds.iteritems():
+            if kind is Readable:
+                rlist.append(fd)
+            else:
+                wlist.append(fd)
+        try:
+            r, w, x = select.select(rlist, wlist, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [(fd, None) for fd in r + w]
+
+    def _watch(self, task, token, sock, kind):
+        fd = sock.fileno()
+        self._fds[fd] = (task, token, sock, kind)
+        if self._poll is not None:
+            self._poll.register(
+                    fd,
+                    select.POLLIN if kind is Readable else select.POLLOUT)
+        task.fds.append(fd)
+
+    def _unwatch(self, task):
+        for fd in task.fds:
+            del self._fds[fd]
+            if self._poll is not None:
+                self._poll.unregister(fd)
+        task.fds = []
+        task.waiting = None
+
+    def _add_timer(self, delay, task, token):
+        self._seq += 1
+        heapq.heappush(self._timers, (time.time() + delay, self._seq,
+                                      task, token))
+
+    def _resume(self, task, future):
+        self._step(task, future._result, future.exc_info())
+
+    def _step(self, task, value, exc_info):
+        while True:
+            gen = task.stack[-1]
+            try:
+                if exc_info is not None:
+                    yielded = gen.throw(*exc_info)
+                else:
+                    yielded = gen.send(value)
+            except Return, r:
+                task.stack.pop()
+                value, exc_info = r.value, None
+            except StopIteration:
+                task.stack.pop()
+                value, exc_info = None, None
+            except:
+                task.stack.pop()
+                value, exc_info = None, sys.exc_info()
+            else:
+                value, exc_info = None, None
+                if isinstance(yielded, types.GeneratorType):
+                    task.stack.append(yielded)
+                    continue
+                elif isinstance(yielded, Future):
+                    yielded.add_done_callback(
+                            lambda f: self.call_soon_threadsafe(
+                                    self._resume, task, f))
+                    return
+                elif isinstance(yielded, (Readable, Writable)):
+                    self._watch(task, yielded, yielded.sock, type(yielded))
+                    task.waiting = yielded
+                    if yielded.timeout is not None:
+                        self._add_timer(yielded.timeout, task, yielded)
+                    return
+                elif isinstance(yielded, Select):
+                    for sock in yielded.rlist:
+                        self._watch(task, yielded, sock, Readable)
+                    for sock in yielded.wlist:
+                        self._watch(task, yielded, sock, Writable)
+                    task.waiting = yielded
+                    if yielded.timeout is not None:
+                        self._add_timer(yielded.timeout, task, yielded)
+                    return
+                elif isinstance(yielded, Sleep):
+                    task.waiting = yielded
+                    self._add_timer(yielded.seconds, task, yielded)
+                    return
+                elif isinstance(yielded, InThread):
+                    if self._executor is not None:
+                        future = self._executor.submit(
+                                yielded.func,
+                                *yielded.args, **yielded.kwargs)
+                        future.add_done_callback(
+                                lambda f: self.call_soon_threadsafe(
+                                        self._resume, task, f))
+                        return
+                    try:
+                        value = yielded.func(*yielded.args, **yielded.kwargs)
+                    except:
+                        exc_info = sys.exc_info()
+                    continue
+                else:
+                    try:
+                        raise TypeError("Coroutine yielded unknown object %r" %
+                                        (yielded,))
+                    except TypeError:
+                        exc_info = sys.exc_info()
+                    continue
+            if not task.stack:
+                if exc_info is not None:
+                    task.future.set_exception(exc_info)
+                else:
+                    task.future.set_result(value)
+                return
+
+
+def _set_nonblocking(fd):
+    try:
+        import fcntl
+    except ImportError:
+        return
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def connect(sock, address, timeout=None):
+    """Coroutine connecting a socket without blocking.
+
+    The socket is left in non-blocking mode.
+    """
+    sock.setblocking(0)
+    err = sock.connect_ex(address)
+    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+        yield Writable(sock, timeout)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err not in (0, errno.EISCONN):
+        raise socket.error(err, os.strerror(err))
+
+
+def run(gen):
+    """Runs a single coroutine to completion in the current thread.
+    """
+    loop = EventLoop()
+    try:
+        return loop.run_until_complete(gen)
+    finally:
+        loop.close()
+
+
+def _interleave_families(addresses):
+    """Orders getaddrinfo() results alternating between address families.
+
+    The family of the first address comes first (RFC 8305, section 4).
+    """
+    families = []
+    queues = dict()
+    for info in addresses:
+        if info[0] not in queues:
+            families.append(info[0])
+            queues[info[0]] = []
+        queues[info[0]].append(info)
+    ordered = []
+    while len(ordered) < len(addresses):
+        for family in families:
+            if queues[family]:
+                ordered.append(queues[family].pop(0))
+    return ordered
+
+
+def connect_staggered(addresses, delay=0.25, timeout=None):
+    """Coroutine connecting to the first reachable address ("happy eyeballs").
+
+    addresses is a list as returned by getaddrinfo(). Connection attempts
+    are started 'delay' seconds apart (or as soon as the previous one
+    failed), alternating between IPv6 and IPv4, and the first one to succeed
+    is used, as recommended by RFC 8305. Each attempt gives up after
+    'timeout' seconds.
+
+    Returns (sock, info, outcomes), where sock is the connected socket (in
+    non-blocking mode) and info its entry in addresses, or None and None if
+    none could be reached. outcomes is a list of (info, outcome) for all the
+    addresses; outcome is 'connected', 'timeout', the errno code of the
+    failure (eg 'ECONNREFUSED'), 'abandoned' if another address connected
+    first, or 'untried'.
+    """
+    pending = _interleave_families(addresses)
+    attempts = dict() # socket -> (info, start time)
+    outcomes = dict() # id(info) -> outcome
+    winner = None
+    next_attempt = time.time()
+
+    def failed(info, err):
+        outcomes[id(info)] = errno.errorcode.get(err, str(err))
+
+    try:
+        while winner is None and (pending or attempts):
+            # Starts the next attempt
+            now = time.time()
+            if pending and (now >= next_attempt or not attempts):
+                info = pending.pop(0)
+                af, socktype, proto, canonname, sa = info
+                try:
+                    sock = socket.socket(af, socktype, proto)
+                except socket.error, e:
+                    failed(info, e.args[0])
+                    continue
+                sock.setblocking(0)
+                err = sock.connect_ex(sa)
+                if err in (0, errno.EISCONN):
+                    winner = sock, info
+                elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                             errno.EAGAIN):
+                    attempts[sock] = info, now
+                    next_attempt = now + delay
+                else:
+                    sock.close()
+                    failed(info, err)
+                continue
+
+            # Waits for an attempt to complete, or for the next one to start
+            deadlines = []
+            if pending:
+                deadlines.append(next_attempt)
+            if timeout is not None:
+                deadlines.extend(start + timeout
+                                 for info, start in attempts.itervalues())
+            if deadlines:
+                wait = max(0, min(deadlines) - now)
+            else:
+                wait = None
+            rlist, wlist = yield Select([], list(attempts), wait)
+            for sock in wlist:
+                info, start = attempts.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err in (0, errno.EISCONN):
+                    if winner is None:
+                        winner = sock, info
+                        continue
+                    outcomes[id(info)] = 'abandoned'
+                else:
+                    failed(info, err)
+                    next_attempt = time.time()
+                sock.close()
+
+            # Attempts that timed out
+            if timeout is not None:
+                now = time.time()
+                for sock, (info, start) in attempts.items():
+                    if now >= start + timeout:
+                        del attempts[sock]
+                        sock.close()
+                        outcomes[id(info)] = 'timeout'
+                        next_attempt = now
+    finally:
+        for sock, (info, start) in attempts.iteritems():
+            sock.close()
+            outcomes[id(info)] = 'abandoned'
+
+    if winner is not None:
+        outcomes[id(winner[1])] = 'connected'
+        sock, info = winner
+    else:
+        sock = info = None
+    raise Return((sock, info,
+                  [(i, outcomes.get(id(i), 'untried')) for i in addresses]))
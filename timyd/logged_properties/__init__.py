@@ -1,4 +1,4 @@
-from .bin_log import BinaryLog, InvalidFile
+from .bin_log import BinaryLog, InvalidFile, LockedFile
 
 from .properties import Property, StringProperty, UnicodeProperty, \
     IntegerProperty, EnumProperty
@@ -1,8 +1,14 @@
 import atexit
+import bisect
+import contextlib
+import errno
 import logging
+import mmap
+import os
 import struct
 import sys
 import time
+import zlib
 
 
 class InvalidFile(Exception):
@@ -10,6 +16,94 @@ class InvalidFile(Exception):
     """
 
 
+class LockedFile(Exception):
+    """The BinaryLog is already opened for writing by another process.
+    """
+
+
+# Format of newly created logs
+DEFAULT_VERSION = 2
+
+_integer = struct.Struct('>q')
+_string_length = struct.Struct('>H')
+# time, next offset, previous offset, length of property_name (or
+# property_id)
+_property_change_head = struct.Struct('>qqqH')
+# BINLOG02: marker, next page offset, capacity, used size
+_table_page_head = struct.Struct('>8sqqq')
+_TABLE_MARKER = 'PROPTABL'
+_TABLE_PAGE_SIZE = 4096
+# BINLOG02 header flags
+FLAG_PROPERTY_IDS = 0x1
+# Journal: size of the entry, CRC32 of the entry
+_JOURNAL_MAGIC = 'BINWAL01'
+_journal_entry_head = struct.Struct('>qI')
+
+
+def _unpack_property_change(buf, pos, with_name=True, names=None):
+    """Decodes a property_change from a buffer, eg a memory-mapped file.
+
+    Returns (time, next offset, previous offset, property_name, value). The
+    property name is only extracted if with_name is True, else it is None.
+    If names is given, the record has a property_id instead of a name, to be
+    looked up in that list.
+    """
+    try:
+        t, next, prev, l = _property_change_head.unpack_from(buf, pos)
+        pos += 26
+        if names is not None:
+            try:
+                prop = names[l] if with_name else None
+            except IndexError:
+                raise InvalidFile
+            l = 0
+        elif with_name:
+            prop = str(buf[pos:pos + l])
+            if len(prop) != l:
+                raise InvalidFile
+        else:
+            prop = None
+        pos += l
+        kind = buf[pos:pos + 1]
+        if kind == b'i':
+            value = _integer.unpack_from(buf, pos + 1)[0]
+        elif kind == b's':
+            l = _string_length.unpack_from(buf, pos + 1)[0]
+            value = str(buf[pos + 3:pos + 3 + l])
+            if len(value) != l:
+                raise InvalidFile
+        else:
+            raise InvalidFile
+    except struct.error:
+        raise InvalidFile
+    return t, next, prev, prop, value
+
+
+def _compact_changes(changes, cutoff, resolution, read):
+    """Filters the (time, value) changes of a property, for compact().
+
+    The number of changes read is added to read[0].
+    """
+    last = held = None
+    for change in changes:
+        read[0] += 1
+        if (change[0] < cutoff and resolution and held is not None and
+                held[0] // resolution == change[0] // resolution):
+            held = change # later in the same interval
+            continue
+        if held is not None and (last is None or held[1] != last[1]):
+            yield held
+            last = held
+        held = None
+        if change[0] >= cutoff:
+            yield change
+            last = change
+        else:
+            held = change
+    if held is not None and (last is None or held[1] != last[1]):
+        yield held
+
+
 class _PropertyIterator(object):
     def __init__(self, log, next_pos, end=None, dir=1):
         self._log = log
@@ -20,8 +114,8 @@ class _PropertyIterator(object):
     def next(self):
         if self._next_pos is None:
             raise StopIteration
-        self._log._file.seek(self._next_pos)
-        t, next, prev, prop, value = self._log._read_property_change()
+        t, next, prev, prop, value = self._log._read_property_change_at(
+                self._next_pos, with_name=False)
         r = False
 
         if self._dir == -1:
@@ -62,15 +156,48 @@ def close_opened_logs():
 atexit.register(close_opened_logs)
 
 
+def _lock(fp):
+    try:
+        import fcntl
+    except ImportError:
+        return
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        raise LockedFile("%s is opened by another process" % fp.name)
+
+
 class BinaryLog(object):
     """A binary log.
 
+    Two formats are supported. In BINLOG01, a summary of the properties is
+    written at the end of the log when it is closed, and dropped by the next
+    change:
+
     log = header, {property_change}, summary;
     header = "BINLOG01", integer (*summary offset*);
     summary = integer (*length*), time,
               {property_name,
                integer (*first prop change offset *),
                integer (*last prop change offset*)};
+
+    In BINLOG02, the properties are listed in table pages, allocated among
+    the records as needed; the entries are updated in place, so that closing
+    a log only writes the entries of the properties that changed:
+
+    log = header, {property_change | table_page};
+    header = "BINLOG02", integer (*flags*), integer (*first table offset*);
+    table_page = "PROPTABL", integer (*next table offset*),
+                 integer (*capacity*), integer (*used size*),
+                 {table_entry}, padding up to capacity;
+    table_entry = property_name,
+                  integer (*first prop change offset *),
+                  integer (*last prop change offset*);
+
+    Both formats share the records:
+
     property_change = time,
                       integer (*next offset*), integer (*previous offset*),
                       property_name, value;
@@ -81,15 +208,113 @@ class BinaryLog(object):
     Strings are prefixed with a 16-bit length in big endian.
     Integers are 64-bit, signed, big endian.
     Times are represented as UNIX timestamps.
+
+    If the BINLOG02 log has the FLAG_PROPERTY_IDS flag (property_ids=True
+    when creating it), records contain a 16-bit property_id instead of the
+    property_name; it is the position of the property's entry in the table,
+    written along with its first record.
+
+    New logs are created in the format given by version, BINLOG02 by
+    default. Existing logs keep their format.
+
+    Readonly logs are memory-mapped unless use_mmap is False; records are then
+    decoded directly from the mapped file instead of through read() calls.
+
+    Readonly logs can be opened with lazy=True: the summary (or the table
+    pages) is then only parsed as far as needed to find the properties that
+    are asked for, instead of entirely when opening. This is faster when only
+    a few properties of logs that have many are read, such as the status.
+    The BINLOG01 summary is still read (not parsed) when opening, as writers
+    drop it.
+
+    If index_interval is set, a sparse time index is kept in a separate file,
+    recording the time and offset of every index_interval-th change of each
+    property; get_property_history() then finds its start position with a
+    binary search instead of following the records one by one. An existing
+    index file is used (and updated) even if index_interval is not set.
+
+    index = "BINIDX01", integer (*size of the log*), integer (*interval*),
+            {property_name,
+             integer (*number of changes*),
+             integer (*number of entries*), {time, integer (*offset*)}};
+
+    If journal is True, each batch is first appended to a journal file next
+    to the log, and flush() (or close()) syncs the log to disk then deletes
+    the journal: a single fsync() per flush, whatever the number of changes.
+    If the journal is still there when the log is opened again (or if the
+    summary or table can't be read), the process died before flushing; the
+    batches of the journal are written again, and the summary or table is
+    rebuilt by reading all the records, skipping the table pages. The log is
+    cut after the last valid record.
+
+    journal = "BINWAL01", {integer (*size*), crc32, journal_entry};
+    journal_entry = integer (*truncated size, or -1*),
+                    integer (*first new property_id*),
+                    integer (*number of new properties*), {property_name},
+                    integer (*number of patches*),
+                    {integer (*offset*), integer (*next offset*)},
+                    integer (*offset of the records*), {property_change};
+
+    Where flock() is available, a writable log holds an exclusive lock on
+    the file until it is closed; opening it again for writing raises
+    LockedFile, so that a log can't be recovered or compacted while it is
+    being written.
     """
 
-    def __init__(self, filename, readonly=False, debug=False):
+    def __init__(self, filename, readonly=False, debug=False, use_mmap=True,
+                 index_interval=None, version=None, property_ids=False,
+                 lazy=False, journal=False):
         global _opened_logs
 
+        if property_ids and (version or DEFAULT_VERSION) != 2:
+            raise ValueError("property_ids requires BINLOG02")
+        if lazy and not readonly:
+            raise ValueError("lazy requires a readonly log")
+        if journal and readonly:
+            raise ValueError("journal requires a writable log")
+
+        self._filename = filename
+
         # property name -> (first offset, last offset)
         self._property_updates = dict()
+        # Summary or table entries not yet in _property_updates:
+        # [[buffer, position, end, file offset of the buffer's start]]
+        self._unparsed = []
+
+        # BINLOG02: property name -> offset of its offsets in the table,
+        # properties changed since the table was written, and the table pages
+        # [(offset, capacity, used size)]
+        self._slots = dict()
+        self._dirty = set()
+        self._pages = []
+
+        # Properties in the order they were added, for property_id; the
+        # properties that have an entry in the table are always the first ones
+        self._names = []
+        self._ids = dict() # property name -> property_id
+        self._property_ids = False
+
+        # property name -> [number of changes, [time], [offset]]
+        self._index = dict()
+        self._index_interval = index_interval
+        self._index_dirty = False
 
         self.debug = debug
+        self._map = None
+
+        # Batched writes: records not yet written and where they go, patches
+        # to the next offset of records already in the file
+        self._batch_depth = 0
+        self._pending = None
+        self._pending_start = None
+        self._patches = dict() # offset -> next offset
+        self._truncate = None
+
+        # Journal of the batches written since the last flush, and number
+        # of properties whose name is in it or in the table
+        self._journal = journal
+        self._journal_file = None
+        self._journaled_names = 0
 
         if readonly:
             self._file = open(filename, 'rb')
@@ -104,53 +329,547 @@ class BinaryLog(object):
                 # creating the file before if necessary
                 open(filename, 'wb').close()
             self._file = open(filename, 'r+b')
+            try:
+                _lock(self._file)
+            except:
+                self._file.close()
+                self._file = None
+                raise
         self._file.seek(0, 2)
         self.readonly = readonly
         self._size = self._file.tell()
 
+        recovered = False
         try:
             if (not self.readonly) and self._size == 0:
                 # Log just created, write header
-                self._file.write('BINLOG01')
-                self._size += 8
-                self._write_integer(0)
+                self.version = version or DEFAULT_VERSION
                 self._summary = None
+                if self.version == 1:
+                    self._file.write('BINLOG01')
+                    self._size += 8
+                    self._write_integer(0)
+                elif self.version == 2:
+                    self._property_ids = property_ids
+                    self._file.write('BINLOG02')
+                    self._size += 8
+                    self._write_integer(FLAG_PROPERTY_IDS if property_ids
+                                        else 0)
+                    self._write_integer(24) # first table page
+                    self._add_table_page()
+                else:
+                    raise ValueError("Unknown BinaryLog version %r" % version)
             else:
-                self._file.seek(0)
-                if self._read(8) != 'BINLOG01':
-                    raise InvalidFile
-                summary = self._read_integer()
-                if summary < 16 or summary >= self._size:
-                    raise InvalidFile
-                self._summary = summary
-                self._file.seek(summary)
-                t, props = self._read_summary()
-                self._property_updates = props
+                if self.readonly and use_mmap and self._size > 0:
+                    self._map = mmap.mmap(self._file.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+                if journal and os.path.exists(self._filename + '.wal'):
+                    self._recover()
+                    recovered = True
+                else:
+                    try:
+                        self._read_header()
+                    except InvalidFile:
+                        if not journal:
+                            raise
+                        self._recover()
+                        recovered = True
+                if not lazy:
+                    self._parse_entries()
         except:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
             self._file.close()
             self._file = None
             raise
         else:
             _opened_logs.add(self)
 
-    def _read_summary(self):
+        if recovered:
+            self.flush()
+        self._load_index()
+
+    def _read_header(self):
+        self._file.seek(0)
+        magic = self._read(8)
+        if magic == 'BINLOG01':
+            self.version = 1
+            summary = self._read_integer()
+            if summary < 16 or summary >= self._size:
+                raise InvalidFile
+            self._summary = summary
+            self._read_summary(summary)
+        elif magic == 'BINLOG02':
+            self.version = 2
+            self._summary = None
+            flags = self._read_integer()
+            if flags & ~FLAG_PROPERTY_IDS:
+                raise InvalidFile
+            self._property_ids = bool(flags & FLAG_PROPERTY_IDS)
+            self._read_table(self._read_integer())
+        else:
+            raise InvalidFile
+        self._journaled_names = len(self._names)
+
+    def _recover(self):
+        """Rebuilds the summary or table from the records, after a crash.
+
+        The batches from the journal are written again first, in case they
+        didn't all make it to the log. The records are then read in order,
+        up to the first one that isn't valid, where the log is cut; their
+        next offsets are fixed, so that they are linked in that order. The
+        new summary or table is written by the next flush().
+        """
+        logging.warning("recovering binary log %s" % self._filename)
+        self._property_updates = dict()
+        self._unparsed = []
+        self._slots = dict()
+        self._pages = []
+        self._names = []
+        self._ids = dict()
+
+        self._file.seek(0)
+        magic = self._read(8)
+        if magic == 'BINLOG01':
+            self.version = 1
+            self._summary = None
+            start = 16
+        elif magic == 'BINLOG02':
+            self.version = 2
+            self._summary = None
+            flags = self._read_integer()
+            if flags & ~FLAG_PROPERTY_IDS:
+                raise InvalidFile
+            self._property_ids = bool(flags & FLAG_PROPERTY_IDS)
+            first_table = self._read_integer()
+            start = 24
+        else:
+            raise InvalidFile
+        journal_names = self._replay_journal()
+        self._file.flush()
+        self._file.seek(0, 2)
+        self._size = self._file.tell()
+
+        ids = self._property_ids
+        first = dict() # property name (or property_id) -> offset
+        last = dict() # property name (or property_id) -> offset
+        nexts = dict() # offset -> next offset in the record
+        links = dict() # offset of a next offset -> value to write there
+        pages = [] # (offset, capacity, used size, next table offset)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            buf = self._map
+            pos = start
+            while pos < self._size:
+                if self.version == 2 and buf[pos:pos + 8] == _TABLE_MARKER:
+                    try:
+                        marker, next, capacity, used = (
+                                _table_page_head.unpack_from(buf, pos))
+                    except struct.error:
+                        break
+                    if (not 0 <= used <= capacity or
+                            pos + 32 + capacity > self._size):
+                        break
+                    self._add_entries(pos + 32, used)
+                    self._parse_entries()
+                    pages.append((pos, capacity, used, next))
+                    pos += 32 + capacity
+                    continue
+                try:
+                    l = _property_change_head.unpack_from(buf, pos)[3]
+                    t, next, prev, key, value = _unpack_property_change(
+                            buf, pos, not ids, [] if ids else None)
+                except (struct.error, InvalidFile):
+                    break
+                if ids:
+                    key = l
+                if prev != last.get(key, 0):
+                    break # not a record of that property
+                if key in last:
+                    if nexts[last[key]] != pos:
+                        links[last[key] + 8] = pos
+                else:
+                    first[key] = pos
+                last[key] = pos
+                nexts[pos] = next
+                pos += 26 + (0 if ids else l)
+                if isinstance(value, (int, long)):
+                    pos += 9
+                else:
+                    pos += 3 + len(value)
+        finally:
+            self._map.close()
+            self._map = None
+
+        for key, offset in last.iteritems():
+            if nexts[offset] != 0:
+                links[offset + 8] = 0
+        if self.version == 2:
+            if not pages:
+                raise InvalidFile
+            if first_table != pages[0][0]:
+                links[16] = pages[0][0]
+            for i, (offset, capacity, used, next) in enumerate(pages):
+                following = pages[i + 1][0] if i + 1 < len(pages) else 0
+                if next != following:
+                    links[offset + 8] = following
+            self._pages = [page[:3] for page in pages]
+
+        # The properties that are not in the table get added to it
+        if ids:
+            for pid in sorted(journal_names):
+                if pid == len(self._names):
+                    self._ids[journal_names[pid]] = pid
+                    self._names.append(journal_names[pid])
+        for key in sorted(first, key=first.get):
+            if ids:
+                if key >= len(self._names):
+                    logging.warning("dropping records of unknown property %d "
+                                    "from %s" % (key, self._filename))
+                    continue
+                prop = self._names[key]
+            else:
+                prop = key
+                if prop not in self._ids:
+                    self._ids[prop] = len(self._names)
+                    self._names.append(prop)
+            self._property_updates[prop] = (first[key], last[key])
+            self._dirty.add(prop)
+        self._journaled_names = len(self._names)
+
+        if pos < self._size:
+            logging.warning("dropping %d bytes at the end of %s" % (
+                    self._size - pos, self._filename))
+            self._file.seek(pos)
+            self._file.truncate()
+            self._size = pos
+        for offset in sorted(links):
+            self._file.seek(offset)
+            self._write_integer(links[offset], overwrite=True)
+
+        # Until the next flush() is complete, a new crash recovers again
+        self._journal_file = open(self._filename + '.wal', 'ab')
+
+    def _replay_journal(self):
+        """Writes again the batches recorded in the journal, if any.
+
+        Returns the names of the properties that were added by them, as a
+        dict property_id -> name.
+        """
+        names = dict()
+        try:
+            fp = open(self._filename + '.wal', 'rb')
+        except IOError:
+            return names
+        with fp:
+            data = fp.read()
+        if data[:8] != _JOURNAL_MAGIC:
+            return names
+        pos = 8
+        while pos + 12 <= len(data):
+            size, crc = _journal_entry_head.unpack_from(data, pos)
+            entry = data[pos + 12:pos + 12 + size]
+            if len(entry) != size or zlib.crc32(entry) & 0xFFFFFFFF != crc:
+                # Not completely written: neither was the batch
+                break
+            pos += 12 + size
+            if self.debug:
+                sys.stderr.write("replaying %d bytes of journal\n" % size)
+
+            truncate, first_id, count = struct.unpack_from('>qqq', entry, 0)
+            i = 24
+            for pid in xrange(first_id, first_id + count):
+                l = _string_length.unpack_from(entry, i)[0]
+                names[pid] = entry[i + 2:i + 2 + l]
+                i += 2 + l
+            if truncate != -1:
+                self._file.seek(truncate)
+                self._file.truncate()
+            patches = _integer.unpack_from(entry, i)[0]
+            i += 8
+            for j in xrange(patches):
+                offset, next = struct.unpack_from('>qq', entry, i)
+                i += 16
+                self._file.seek(offset)
+                self._file.write(_integer.pack(next))
+            offset = _integer.unpack_from(entry, i)[0]
+            self._file.seek(offset)
+            self._file.write(entry[i + 8:])
+        return names
+
+    def _write_journal(self):
+        """Appends the pending batch to the journal.
+        """
+        buf = bytearray(_integer.pack(-1 if self._truncate is None
+                                      else self._truncate))
+        names = self._names[self._journaled_names:]
+        buf.extend(struct.pack('>qq', self._journaled_names, len(names)))
+        for name in names:
+            buf.extend(_string_length.pack(len(name)))
+            buf.extend(name)
+        buf.extend(_integer.pack(len(self._patches)))
+        for offset in sorted(self._patches):
+            buf.extend(struct.pack('>qq', offset, self._patches[offset]))
+        buf.extend(_integer.pack(self._pending_start))
+        buf.extend(self._pending)
+        buf = bytes(buf)
+        if self._journal_file is None:
+            self._journal_file = open(self._filename + '.wal', 'wb')
+            self._journal_file.write(_JOURNAL_MAGIC)
+        self._journal_file.write(_journal_entry_head.pack(
+                len(buf), zlib.crc32(buf) & 0xFFFFFFFF))
+        self._journal_file.write(buf)
+        # Reaches the system before the log, so it survives if the process
+        # is killed; it is not synced, the flush() does that for the log
+        self._journal_file.flush()
+        self._journaled_names = len(self._names)
+
+    def _load_index(self):
+        """Loads the index file, if it exists and matches this log.
+        """
+        try:
+            fp = open(self._filename + '.idx', 'rb')
+        except IOError:
+            return
+        with fp:
+            data = fp.read()
+        try:
+            magic, size, interval = struct.unpack_from('>8sqq', data, 0)
+            if magic != 'BINIDX01' or interval < 1:
+                return
+            if size != self._size:
+                logging.debug("ignoring outdated index for %s" %
+                              self._filename)
+                return
+            index = dict()
+            pos = 24
+            while pos < len(data):
+                l = _string_length.unpack_from(data, pos)[0]
+                prop = data[pos + 2:pos + 2 + l]
+                pos += 2 + l
+                count, entries = struct.unpack_from('>qq', data, pos)
+                pos += 16
+                pairs = struct.unpack_from('>%dq' % (2 * entries), data, pos)
+                pos += 16 * entries
+                index[prop] = [count, list(pairs[0::2]), list(pairs[1::2])]
+        except struct.error:
+            logging.warning("invalid index file for %s" % self._filename)
+            return
+        self._index = index
+        self._index_interval = interval
+
+    def _write_index(self):
+        buf = bytearray(struct.pack('>8sqq', 'BINIDX01',
+                                    self._size, self._index_interval))
+        for prop, (count, times, offsets) in self._index.iteritems():
+            buf.extend(_string_length.pack(len(prop)))
+            buf.extend(prop)
+            buf.extend(struct.pack('>qq', count, len(times)))
+            pairs = [None] * (2 * len(times))
+            pairs[0::2] = times
+            pairs[1::2] = offsets
+            buf.extend(struct.pack('>%dq' % len(pairs), *pairs))
+        filename = self._filename + '.idx'
+        with open(filename + '.tmp', 'wb') as fp:
+            fp.write(buf)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename + '.tmp', filename)
+        self._index_dirty = False
+
+    def _get_index(self, prop):
+        """Gets the index entry of a property, building it if needed.
+
+        Returns None if the index is not enabled.
+        """
+        if not self._index_interval:
+            return None
+        try:
+            return self._index[prop]
+        except KeyError:
+            pass
         if self.debug:
-            sys.stderr.write("_read_summary @ %r\n" % self._file.tell())
-        offset = self._file.tell()
-        size = self._read_integer() # length
+            sys.stderr.write("building index for %r\n" % prop)
+        entry = [0, [], []]
+        pos = self._lookup(prop)[0] # might raise KeyError
+        while pos != 0:
+            t, next, prev, name, value = self._read_property_change_at(
+                    pos, with_name=False)
+            if entry[0] % self._index_interval == 0:
+                entry[1].append(t)
+                entry[2].append(pos)
+            entry[0] += 1
+            pos = next
+        self._index[prop] = entry
+        self._index_dirty = True
+        return entry
+
+    def _read_summary(self, offset):
+        """Finds the entries of the summary (BINLOG01).
+        """
+        if self.debug:
+            sys.stderr.write("_read_summary @ %r\n" % offset)
+        size, t = struct.unpack('>qq', self._read_block(offset, 16))
         if size < 16:
             raise InvalidFile
-        t = self._read_integer() # time
-        props = dict()
-        end = offset + size
-        offset = self._file.tell()
-        while offset < end:
-            prop = self._read_string()
-            first = self._read_integer()
-            last = self._read_integer()
-            props[prop] = (first, last)
-            offset = self._file.tell()
-        return t, props
+        self._add_entries(offset + 16, size - 16)
+
+    def _read_block(self, offset, size):
+        if self._map is not None:
+            data = self._map[offset:offset + size]
+            if len(data) != size:
+                raise InvalidFile
+            return data
+        self._file.seek(offset)
+        return self._read(size)
+
+    def _add_entries(self, offset, size):
+        """Adds a block of summary or table entries, to be parsed later.
+
+        The BINLOG01 summary is copied: a writer truncates it on the next
+        change, and reading the map past the end of the file would kill the
+        process (SIGBUS). The BINLOG02 table pages are never truncated.
+        """
+        if self._map is not None and self.version == 2:
+            if offset + size > self._size:
+                raise InvalidFile
+            self._unparsed.append([self._map, offset, offset + size, 0])
+        else:
+            self._unparsed.append([self._read_block(offset, size), 0, size,
+                                   offset])
+
+    def _parse_entries(self, stop=None):
+        """Parses the summary or table entries not yet parsed.
+
+        If stop is given, parsing stops after the entry of that property;
+        returns whether it was found.
+        """
+        while self._unparsed:
+            entries = self._unparsed[0]
+            buf, pos, end, start = entries
+            try:
+                while pos < end:
+                    l = _string_length.unpack_from(buf, pos)[0]
+                    prop = buf[pos + 2:pos + 2 + l]
+                    pos += 2 + l
+                    self._property_updates[prop] = struct.unpack_from(
+                            '>qq', buf, pos)
+                    if self.version == 2:
+                        self._slots[prop] = start + pos
+                        self._ids[prop] = len(self._names)
+                        self._names.append(prop)
+                    pos += 16
+                    if prop == stop:
+                        entries[1] = pos
+                        return True
+            except struct.error:
+                raise InvalidFile
+            self._unparsed.pop(0)
+        return False
+
+    def _lookup(self, prop):
+        """Returns the (first offset, last offset) of a property.
+
+        Raises KeyError if the property is not in the log.
+        """
+        try:
+            return self._property_updates[prop]
+        except KeyError:
+            if not self._parse_entries(prop):
+                raise KeyError(prop)
+        return self._property_updates[prop]
+
+    def _read_table(self, offset):
+        last = 0
+        while offset != 0:
+            if self.debug:
+                sys.stderr.write("_read_table @ %r\n" % offset)
+            if offset <= last:
+                raise InvalidFile # pages are only added at the end
+            last = offset
+            marker, next, capacity, used = _table_page_head.unpack(
+                    self._read_block(offset, 32))
+            if marker != _TABLE_MARKER or not 0 <= used <= capacity:
+                raise InvalidFile
+            self._add_entries(offset + 32, used)
+            self._pages.append((offset, capacity, used))
+            offset = next
+
+    def _add_table_page(self, min_size=0):
+        """Appends a new empty table page (BINLOG02).
+        """
+        capacity = max(_TABLE_PAGE_SIZE, min_size)
+        offset = self._size
+        self._file.seek(offset)
+        self._file.write(_table_page_head.pack(_TABLE_MARKER, 0, capacity, 0))
+        self._file.write(b'\0' * capacity)
+        self._size += 32 + capacity
+        if self._pages:
+            self._file.seek(self._pages[-1][0] + 8)
+            self._write_integer(offset, overwrite=True)
+        self._pages.append((offset, capacity, 0))
+
+    def _write_table(self):
+        """Updates the table entries of the changed properties (BINLOG02).
+        """
+        if self._pending_start is not None:
+            self._write_batch()
+        if self.debug:
+            sys.stderr.write("writing table: %d entries\n" % len(self._dirty))
+
+        for prop in sorted((p for p in self._dirty if p in self._slots),
+                           key=self._slots.get):
+            self._file.seek(self._slots[prop])
+            self._file.write(struct.pack('>qq', *self._property_updates[prop]))
+        self._append_table_entries()
+
+        self._dirty = set()
+
+    def _append_table_entries(self):
+        """Adds the table entries of new properties (BINLOG02).
+        """
+        grown_pages = set()
+        for prop in self._names[len(self._slots):]:
+            entry = (_string_length.pack(len(prop)) + prop +
+                     struct.pack('>qq', *self._property_updates[prop]))
+            offset, capacity, used = self._pages[-1]
+            if used + len(entry) > capacity:
+                self._add_table_page(len(entry))
+                offset, capacity, used = self._pages[-1]
+            self._file.seek(offset + 32 + used)
+            self._file.write(entry)
+            self._slots[prop] = offset + 32 + used + 2 + len(prop)
+            self._pages[-1] = (offset, capacity, used + len(entry))
+            grown_pages.add(len(self._pages) - 1)
+        for i in sorted(grown_pages):
+            offset, capacity, used = self._pages[i]
+            self._file.seek(offset + 24)
+            self._write_integer(used, overwrite=True)
+
+    def _id_names(self):
+        return self._names if self._property_ids else None
+
+    def _read_property_change_at(self, pos, with_name=True):
+        """Reads the property_change record at the given offset.
+        """
+        if self._pending_start is not None and pos >= self._pending_start:
+            if self.debug:
+                sys.stderr.write("_unpack_property_change @ %r (pending)\n" %
+                                 pos)
+            return _unpack_property_change(self._pending,
+                                           pos - self._pending_start,
+                                           with_name, self._id_names())
+        if self._map is not None:
+            if self.debug:
+                sys.stderr.write("_unpack_property_change @ %r\n" % pos)
+            return _unpack_property_change(self._map, pos, with_name,
+                                           self._id_names())
+        self._file.seek(pos)
+        t, next, prev, prop, value = self._read_property_change()
+        if self._patches:
+            next = self._patches.get(pos + 8, next)
+        return t, next, prev, prop, value
 
     def _read_property_change(self):
         if self.debug:
@@ -159,21 +878,34 @@ class BinaryLog(object):
         return (self._read_integer(), # time
                 self._read_integer(), # next offset
                 self._read_integer(), # previous offset
-                self._read_string(), # property_name
+                self._read_property_name(), # property_name or property_id
                 self._read_value()) # value
 
+    def _read_property_name(self):
+        if not self._property_ids:
+            return self._read_string()
+        pid = struct.unpack('>H', self._read(2))[0]
+        if pid >= len(self._names):
+            self._parse_entries()
+        try:
+            return self._names[pid]
+        except IndexError:
+            raise InvalidFile
+
     def get_property(self, prop):
         """Gets the current value of a property.
         """
         if self.debug:
             sys.stderr.write("get_property(%r)\n" % prop)
-        pos = self._property_updates[prop] # might raise KeyError
-        self._file.seek(pos[1])
-        t, next, prev, prop, value = self._read_property_change()
+        pos = self._lookup(prop) # might raise KeyError
+        t, next, prev, prop, value = self._read_property_change_at(
+                pos[1], with_name=False)
         return (t, value)
 
     def set_property(self, prop, value, t=None):
         """Records a new value of a property.
+
+        Outside of a batch, the change is written immediately.
         """
         if self.readonly:
             raise ValueError("set_property() called on a readonly log")
@@ -187,41 +919,125 @@ class BinaryLog(object):
         if t is None:
             t = int(time.time())
 
-        if self._summary:
-            if self.debug:
-                sys.stderr.write("truncating summary\n")
-            self._file.seek(self._summary)
-            self._file.truncate()
-            self._size = self._file.tell()
-            self._summary = None
-
+        self.begin_batch()
         try:
-            pos = self._property_updates[prop] # might raise KeyError
-            self._file.seek(pos[1] + 8)
-            # Overwrite the next offset
-            self._write_integer(self._size, overwrite=True)
-        except KeyError:
-            pos = None
+            if self._pending_start is None:
+                if self._summary:
+                    # The summary will be overwritten by the new records
+                    self._truncate = self._summary
+                    self._size = self._summary
+                    self._summary = None
+                self._pending_start = self._size
 
-        self._file.seek(0, 2)
+            offset = self._size
+            pos = self._property_updates.get(prop)
+            self._dirty.add(prop)
+            if pos is None:
+                if self._property_ids and len(self._names) > 0xFFFF:
+                    raise ValueError("Too many properties for property_ids")
+                self._ids[prop] = len(self._names)
+                self._names.append(prop)
 
-        if pos is not None:
-            self._property_updates[prop] = (pos[0], self._size)
-        else:
-            self._property_updates[prop] = (self._size, self._size)
-
-        self._write_integer(t)
-        self._write_integer(0)
-        self._write_integer(pos[1] if pos else 0)
-        self._write_string(prop)
-        if isinstance(value, (int, long)):
-            self._file.write('i')
-            self._size += 1
-            self._write_integer(value)
-        else:
-            self._file.write('s')
-            self._size += 1
-            self._write_string(value)
+            if self._index_interval:
+                if pos is None:
+                    entry = self._index[prop] = [0, [], []]
+                else:
+                    entry = self._get_index(prop)
+                if entry[0] % self._index_interval == 0:
+                    entry[1].append(t)
+                    entry[2].append(offset)
+                entry[0] += 1
+                self._index_dirty = True
+
+            if pos is None:
+                self._property_updates[prop] = (offset, offset)
+            else:
+                # Overwrite the next offset of the previous record
+                if pos[1] >= self._pending_start:
+                    _integer.pack_into(self._pending,
+                                       pos[1] - self._pending_start + 8,
+                                       offset)
+                else:
+                    self._patches[pos[1] + 8] = offset
+                self._property_updates[prop] = (pos[0], offset)
+
+            buf = self._pending
+            if self._property_ids:
+                buf.extend(_property_change_head.pack(
+                        t, 0, pos[1] if pos else 0, self._ids[prop]))
+            else:
+                buf.extend(_property_change_head.pack(
+                        t, 0, pos[1] if pos else 0, len(prop)))
+                buf.extend(prop)
+            if isinstance(value, (int, long)):
+                buf.extend(b'i')
+                buf.extend(_integer.pack(value))
+            else:
+                buf.extend(b's')
+                buf.extend(_string_length.pack(len(value)))
+                buf.extend(value)
+            self._size = self._pending_start + len(buf)
+        finally:
+            self.end_batch()
+
+    def begin_batch(self):
+        """Starts gathering changes, to be written at once by end_batch().
+
+        Batches can be nested; the changes are written when the outermost one
+        ends, or when the log is closed. Changes are visible to readers of
+        this object right away.
+        """
+        if self.readonly:
+            raise ValueError("begin_batch() called on a readonly log")
+        if self._batch_depth == 0:
+            self._pending = bytearray()
+        self._batch_depth += 1
+
+    def end_batch(self):
+        """Ends a batch started with begin_batch().
+        """
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self._write_batch()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager gathering the changes into a single write.
+
+            with log.batch():
+                log['status'] = ''
+                log['banner'] = "SSH-2.0-OpenSSH"
+        """
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.end_batch()
+
+    def _write_batch(self):
+        if self._pending_start is not None:
+            if self.debug:
+                sys.stderr.write("writing batch: %d bytes, %d patches\n" % (
+                                 len(self._pending), len(self._patches)))
+            if self._journal:
+                self._write_journal()
+            if self._truncate is not None:
+                self._file.seek(self._truncate)
+                self._file.truncate()
+                self._truncate = None
+            for offset in sorted(self._patches):
+                self._file.seek(offset)
+                self._file.write(_integer.pack(self._patches[offset]))
+            self._file.seek(self._pending_start)
+            self._file.write(self._pending)
+            if self._journal:
+                self._file.flush()
+        self._pending = bytearray() if self._batch_depth > 0 else None
+        self._pending_start = None
+        self._patches = dict()
+        if self._property_ids:
+            # The records refer to the table entries, write them now
+            self._append_table_entries()
 
     def get_property_history(self, prop, start=None, end=None,
             dir=1, search=1):
@@ -234,17 +1050,24 @@ class BinaryLog(object):
         more recent record returned, and end should probably be smaller.
         search indicates how to look for start in the file; either reading from
         the beginning (1, default) or the end (-1). Use it if you know the
-        requested position is closer to one extremity of the file.
+        requested position is closer to one extremity of the file. If the log
+        has an index, reading starts from the closest indexed change instead.
         """
-        pos = self._property_updates[prop] # might raise KeyError
+        pos = self._lookup(prop) # might raise KeyError
         if start is None:
             if dir == 1:
                 return _PropertyIterator(self, pos[0], end, dir=1)
             else:
                 return _PropertyIterator(self, pos[1], end, dir=-1)
 
+        entry = self._get_index(prop)
         if search == 1:
             pos = pos[0]
+            if entry is not None:
+                # Start from the last indexed change before start
+                i = bisect.bisect_left(entry[1], start) - 1
+                if i >= 0:
+                    pos = entry[2][i]
             def found(tm):
                 return tm >= start
             def nextpos(prev, next):
@@ -252,6 +1075,11 @@ class BinaryLog(object):
             t = start - 1
         elif search == -1:
             pos = pos[1]
+            if entry is not None:
+                # Start from the first indexed change after start
+                i = bisect.bisect_right(entry[1], start)
+                if i < len(entry[1]):
+                    pos = entry[2][i]
             def found(tm):
                 return tm <= start
             def nextpos(prev, next):
@@ -260,8 +1088,8 @@ class BinaryLog(object):
 
         last = pos
         while pos != 0:
-            self._file.seek(pos)
-            t, next, prev, prop, value = self._read_property_change()
+            t, next, prev, prop, value = self._read_property_change_at(
+                    pos, with_name=False)
             if found(t):
                 if search != dir and t != start:
                     return _PropertyIterator(self, last, end, dir=dir)
@@ -271,19 +1099,122 @@ class BinaryLog(object):
             pos = nextpos(prev, next)
         return _PropertyIterator(None, None) # empty iterator
 
+    def flush(self, t=None):
+        """Writes pending changes and the summary, keeping the log open.
+
+        A log that is closed or flushed can be read by others. With
+        BINLOG01, the next change will drop the summary again.
+        """
+        if self.readonly:
+            return
+        if self._batch_depth > 0:
+            raise ValueError("flush() called during a batch")
+        if self.version == 1:
+            if self._summary is None:
+                self.write_summary(t)
+        elif self._dirty or self._pending_start is not None:
+            self._write_table()
+        if self._index_interval and self._index_dirty:
+            self._write_index()
+        self._file.flush()
+        if self._journal_file is not None:
+            os.fsync(self._file.fileno())
+            self._journal_file.close()
+            self._journal_file = None
+            os.remove(self._filename + '.wal')
+
     def close(self, t=None):
         global _opened_logs
-        _opened_logs.remove(self)
+        _opened_logs.discard(self)
         if self._file is None:
             return
-        if not self.readonly and self._summary is None:
-            self.write_summary(t)
-        self._file.close()
-        self._file = None
+        try:
+            if self._batch_depth > 0:
+                self._batch_depth = 0
+                self._write_batch()
+            self.flush(t)
+        finally:
+            # Even if writing failed, so that the lock is released
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.close()
+            self._file = None
         if self.debug:
             sys.stderr.write("closed\n\n")
 
+    def compact(self, keep, resolution=None, t=None):
+        """Rewrites the log, dropping the details of old changes.
+
+        The changes of the last 'keep' seconds (before t, default now) are
+        all kept. Of the older ones, only those that change the value of the
+        property are kept; if resolution is given, only the last one in each
+        interval of that many seconds, so a value that didn't last might be
+        lost.
+
+        The records are copied to a new file, property by property, and that
+        file replaces the log, with a new index if the log had one. This log
+        is closed, only after being replaced, so that no other process
+        opens it in between. Returns the number of records before and after.
+        """
+        if self.readonly:
+            raise ValueError("compact() called on a readonly log")
+        if self._batch_depth > 0:
+            raise ValueError("compact() called during a batch")
+        if t is None:
+            t = int(time.time())
+        cutoff = t - keep
+
+        filename = self._filename + '.compact'
+        for f in (filename, filename + '.idx'):
+            if os.path.exists(f):
+                os.remove(f)
+        new = BinaryLog(filename, version=self.version,
+                        property_ids=self._property_ids,
+                        index_interval=self._index_interval or None)
+        read = [0]
+        written = 0
+        try:
+            new.begin_batch()
+            for prop in sorted(self._property_updates,
+                               key=self._property_updates.get):
+                for tm, value in _compact_changes(
+                        self.get_property_history(prop), cutoff, resolution,
+                        read):
+                    new.set_property(prop, value, t=tm)
+                    written += 1
+                    if written % 4096 == 0:
+                        new.end_batch()
+                        new.begin_batch()
+            new.end_batch()
+            new.close(t)
+            with open(filename, 'rb') as fp:
+                os.fsync(fp.fileno())
+        except:
+            if new._file is not None:
+                new.close(t)
+            os.remove(filename)
+            raise
+
+        self.flush(t)
+        if os.name == 'nt':
+            self.close(t) # open files can't be replaced
+        for src, dst in ((filename, self._filename),
+                         (filename + '.idx', self._filename + '.idx')):
+            if os.name == 'nt' and os.path.exists(dst):
+                os.remove(dst)
+            if os.path.exists(src):
+                os.rename(src, dst)
+            elif os.path.exists(dst):
+                os.remove(dst) # index of the old log
+        self.close(t)
+        return read[0], written
+
     def write_summary(self, t=None):
+        if self.version != 1:
+            raise ValueError("write_summary() called on a BINLOG%02d log" %
+                             self.version)
+
         if t is None:
             t = int(time.time())
 
@@ -291,26 +1222,28 @@ class BinaryLog(object):
             raise ValueError("write_summary() called on already summarized "
                              "binary log")
 
+        if self._pending_start is not None:
+            self._write_batch()
+
         offset = self._size
 
         self._file.seek(8)
         self._write_integer(
                 offset,
                 overwrite=True)
-        self._file.seek(0, 2)
 
-        self._write_integer(0) # length: overwrite later - probably inefficient
-        self._write_integer(t) # time
+        buf = bytearray(16) # length and time, packed below
         for prop, offsets in self._property_updates.iteritems():
-            self._write_string(prop)
-            self._write_integer(offsets[0])
-            self._write_integer(offsets[1])
-
-        size = self._file.tell() - offset
+            buf.extend(_string_length.pack(len(prop)))
+            buf.extend(prop)
+            buf.extend(struct.pack('>qq', offsets[0], offsets[1]))
+        struct.pack_into('>qq', buf, 0, len(buf), t)
         self._file.seek(offset)
-        self._write_integer(size, overwrite=True)
+        self._file.write(buf)
+        self._size += len(buf)
 
         self._summary = offset
+        self._dirty = set()
 
     def _read(self, size):
         s = self._file.read(size)
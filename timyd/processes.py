@@ -0,0 +1,223 @@
+"""Runs the checks of a site in several processes.
+
+The services are split into shards, so that a service and everything
+connected to it through dependencies are in the same process. Each worker
+process owns the logs of its services. The events for the actions are sent
+back to the parent process as they happen, and the parent calls the actions.
+"""
+
+import heapq
+import logging
+import multiprocessing
+import Queue
+import traceback
+
+from timyd import Action, CheckFailure, SiteManager
+
+
+class RemoteFailure(CheckFailure):
+    """Stands for a CheckFailure raised in a worker process.
+
+    Exceptions can't always be pickled (CheckFailure subclasses often have
+    constructors with other arguments), so only their class name and message
+    are sent.
+    """
+
+    def __init__(self, name, msg):
+        self.name = name
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class _ForwardAction(Action):
+    """Action of the worker processes, sending the events to the parent.
+    """
+
+    def __init__(self, queue):
+        self._queue = queue
+
+    def register_status_change(self, site, service, old_status, new_status):
+        self._queue.put(('register_status_change',
+                         (service, old_status, new_status)))
+
+    def register_property_change(self, site, service, name,
+            old_value, new_value):
+        self._queue.put(('register_property_change',
+                         (service, name, old_value, new_value)))
+
+    def register_service_check(self, site, service,
+            old_status, status, error, warnings):
+        if error is not None:
+            error = (error.__class__.__name__, str(error))
+        self._queue.put(('register_service_check',
+                         (service, old_status, status, error,
+                          list(warnings))))
+
+
+def connected_components(site, services):
+    """Groups services connected through dependencies, in either direction.
+
+    The dependencies are included. Returns a list of lists of services.
+    """
+    neighbors = dict() # Service -> set(Service)
+    todo = list(services)
+    while todo:
+        service = todo.pop()
+        if service in neighbors:
+            continue
+        neighbors.setdefault(service, set())
+        for dep in site.get_dependencies(service):
+            neighbors[service].add(dep)
+            neighbors.setdefault(dep, set()).add(service)
+            todo.append(dep)
+
+    components = []
+    seen = set()
+    for service in neighbors:
+        if service in seen:
+            continue
+        component = []
+        todo = [service]
+        seen.add(service)
+        while todo:
+            s = todo.pop()
+            component.append(s)
+            for n in neighbors[s]:
+                if n not in seen:
+                    seen.add(n)
+                    todo.append(n)
+        components.append(component)
+    return components
+
+
+def shard(components, count):
+    """Distributes the components into 'count' lists of similar sizes.
+    """
+    shards = [(0, i, []) for i in xrange(count)]
+    for component in sorted(components, key=len, reverse=True):
+        size, i, services = heapq.heappop(shards)
+        services.extend(component)
+        heapq.heappush(shards, (size + len(component), i, services))
+    shards.sort(key=lambda s: s[1])
+    return [services for size, i, services in shards if services]
+
+
+def _worker(runner, services, queue):
+    # Taken by the parent to fork
+    _release_logging_locks()
+    site = runner.site
+    try:
+        # The actions are run by the parent
+        site.actions = [_ForwardAction(queue)]
+        site._events = None
+        SiteManager.event_queue = 0
+        runner.processes = 1
+        # The dependencies that were not added to the site are checked along
+        # with the services that depend on them
+        names = [s.name for s in services if site.services.get(s.name) is s]
+        try:
+            runner.check_services(names)
+        finally:
+            for service in services:
+                service.end_run()
+            SiteManager.close_logs()
+    except Exception, e:
+        queue.put(('error', (multiprocessing.current_process().name,
+                             e.__class__.__name__, str(e),
+                             traceback.format_exc())))
+    else:
+        queue.put(('done', (multiprocessing.current_process().name,
+                            [i for i, s in enumerate(services)
+                             if s in runner._checked_services])))
+    queue.close()
+    queue.join_thread()
+
+
+def _logging_locks():
+    handlers = [ref() for ref in logging._handlerList]
+    return [h for h in handlers if h is not None and h.lock is not None]
+
+
+def _acquire_logging_locks():
+    """Takes the locks of the logging module, before forking.
+
+    A process forked while another thread (eg the one sending the mails)
+    holds them would wait on them forever. Taken by the thread that forks,
+    which is the one left in the child, they are released in both.
+    """
+    logging._acquireLock()
+    for handler in _logging_locks():
+        handler.acquire()
+
+
+def _release_logging_locks():
+    for handler in reversed(_logging_locks()):
+        handler.release()
+    logging._releaseLock()
+
+
+def check_services(runner, services, processes):
+    """Checks the services in worker processes, dispatching their events.
+
+    Returns the services that were checked.
+    """
+    site = runner.site
+    shards = shard(connected_components(site, services), processes)
+    # The thread of the actions could also hold some of their locks: the
+    # pending events are delivered and it is stopped (the next event starts
+    # it again). The thread sending the mails is not waited for.
+    if site._events is not None:
+        site._events.stop()
+    queue = multiprocessing.Queue()
+    workers = []
+    worker_shards = dict() # worker name -> [Service]
+    for i, members in enumerate(shards):
+        logging.debug("worker %d: %d services" % (i, len(members)))
+        worker = multiprocessing.Process(target=_worker,
+                                         args=(runner, members, queue),
+                                         name='timyd-worker-%d' % i)
+        worker_shards[worker.name] = members
+        _acquire_logging_locks()
+        try:
+            worker.start()
+        finally:
+            _release_logging_locks()
+        workers.append(worker)
+
+    checked = set()
+    errors = []
+    pending = set(worker.name for worker in workers)
+    exited = set()
+    while pending:
+        try:
+            kind, args = queue.get(timeout=0.5)
+        except Queue.Empty:
+            # A worker that died before reporting would be waited on forever;
+            # wait one more timeout, as its last messages might be in transit
+            for worker in workers:
+                if worker.name in pending and worker.exitcode is not None:
+                    if worker.name in exited:
+                        errors.append("%s exited with code %d" % (
+                                worker.name, worker.exitcode))
+                        pending.discard(worker.name)
+                    exited.add(worker.name)
+            continue
+        if kind == 'done':
+            members = worker_shards[args[0]]
+            checked.update(members[i] for i in args[1])
+            pending.discard(args[0])
+        elif kind == 'error':
+            errors.append("%s: %s: %s\n%s" % args)
+            pending.discard(args[0])
+        else:
+            if kind == 'register_service_check' and args[3] is not None:
+                args = args[:3] + (RemoteFailure(*args[3]),) + args[4:]
+            site._dispatch(kind, *args)
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise Exception("Error in worker process:\n%s" % '\n'.join(errors))
+    return checked
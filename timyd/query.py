@@ -0,0 +1,140 @@
+"""Queries on the recorded logs, without running any check.
+
+The logs are opened read-only and lazily, and only the records needed to
+answer are read, through BinaryLog.get_property_history().
+"""
+
+import calendar
+import logging
+import os
+import time
+
+from timyd.eventloop import Executor
+from timyd.logged_properties import BinaryLog, InvalidFile
+
+
+def parse_time(value):
+    """Parses a time given on the command line, as UTC.
+
+    Accepts a Unix timestamp, 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' or
+    'YYYY-MM-DD HH:MM:SS' (or with a 'T' separator).
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    value = value.replace('T', ' ')
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, format))
+        except ValueError:
+            pass
+    raise ValueError("Invalid time %r" % (value,))
+
+
+def format_time(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))
+
+
+def list_logs(logs, site, services=None):
+    """Returns [(service, path)] for the logs of a site.
+    """
+    directory = os.path.join(logs, site)
+    if not os.path.isdir(directory):
+        raise ValueError("No logs for site %r in %s" % (site, logs))
+    found = sorted(f[:-7] for f in os.listdir(directory)
+                   if f.endswith('.binlog'))
+    if services:
+        missing = set(services) - set(found)
+        if missing:
+            raise ValueError("No log for service(s) %s" % (
+                    ', '.join(sorted(missing)),))
+        found = [s for s in found if s in services]
+    return [(s, os.path.join(directory, '%s.binlog' % s)) for s in found]
+
+
+def _open(path):
+    # A running daemon might be writing the log; it truncates the summary of
+    # a BINLOG01 log, which can't be read through a map then
+    with open(path, 'rb') as fp:
+        magic = fp.read(8)
+    return BinaryLog(path, readonly=True, lazy=True,
+                     use_mmap=magic != 'BINLOG01')
+
+
+def status(path):
+    """Returns (status, time of the last change), or None if never checked.
+    """
+    with _open(path) as log:
+        try:
+            t, value = log.get_property('status')
+        except KeyError:
+            return None
+        # Only changes are recorded: this is when it got this status
+        return value, t
+
+
+def changes(path, prop, start=None, end=None):
+    """Returns the [(time, value)] changes of a property between two times.
+    """
+    with _open(path) as log:
+        try:
+            if start is None:
+                history = log.get_property_history(prop, end=end)
+            else:
+                history = log.get_property_history(prop, start, end)
+        except KeyError:
+            return []
+        return list(history)
+
+
+def uptime(path, start, end):
+    """Returns the fraction of the time between start and end that the
+    service was OK, or None if nothing is known about that period.
+
+    The status is assumed unchanged between two records; the time before the
+    first record is not counted.
+    """
+    with _open(path) as log:
+        try:
+            history = log.get_property_history('status', dir=-1)
+        except KeyError:
+            return None
+        up = total = 0
+        until = end
+        for t, value in history:
+            if t >= end:
+                continue
+            period = until - max(t, start)
+            total += period
+            if value == '':
+                up += period
+            if t <= start:
+                break
+            until = t
+        if total <= 0:
+            return None
+        return float(up) / total
+
+
+def run_query(query, logs, jobs=4):
+    """Calls query(path) on each log, in parallel.
+
+    logs is [(service, path)]; returns [(service, result)] in the same order.
+    The logs that can't be read (eg while a writer is updating a BINLOG01
+    summary) are reported and left out.
+    """
+    if not logs:
+        return []
+    executor = Executor(min(jobs, len(logs)), name='timyd-query')
+    try:
+        futures = [executor.submit(query, path) for service, path in logs]
+        results = []
+        for (service, path), future in zip(logs, futures):
+            try:
+                results.append((service, future.result()))
+            except InvalidFile:
+                logging.error("%s: invalid log, skipped" % service)
+        return results
+    finally:
+        executor.shutdown()
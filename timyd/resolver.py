@@ -0,0 +1,92 @@
+import logging
+import socket
+import threading
+import time
+
+from timyd.eventloop import Executor
+
+
+class Resolver(object):
+    """Caches the results of getaddrinfo(), shared by all the checks.
+
+    Names are resolved once for every port: the port is filled in the
+    cached addresses. Results are kept for 'ttl' seconds, and failures
+    (socket.gaierror) for 'negative_ttl' seconds. Concurrent lookups of the
+    same name are only sent once.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=60):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        # (host, family, type) -> (expires, addresses, gaierror args)
+        self._cache = dict()
+        self._pending = dict() # (host, family, type) -> threading.Event
+
+    def getaddrinfo(self, host, port, family=socket.AF_UNSPEC,
+                    socktype=socket.SOCK_STREAM):
+        """Cached version of socket.getaddrinfo(); port is a number.
+        """
+        addresses = self._lookup((host, family, socktype))
+        return [(af, type, proto, canonname,
+                 (sockaddr[0], port) + sockaddr[2:])
+                for af, type, proto, canonname, sockaddr in addresses]
+
+    def _lookup(self, key):
+        while True:
+            with self._lock:
+                entry = self._cache.get(key)
+                if entry is not None and entry[0] > time.time():
+                    expires, addresses, error = entry
+                    if error is not None:
+                        raise socket.gaierror(*error)
+                    return addresses
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    break
+            # Being resolved by another thread
+            event.wait()
+
+        host, family, socktype = key
+        addresses = error = None
+        try:
+            addresses = socket.getaddrinfo(host, 0, family, socktype)
+        except socket.gaierror, e:
+            error = e.args
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+        finally:
+            with self._lock:
+                if addresses is not None or error is not None:
+                    self._cache[key] = time.time() + ttl, addresses, error
+                del self._pending[key]
+            event.set()
+        if error is not None:
+            raise socket.gaierror(*error)
+        return addresses
+
+    def prefetch(self, hosts, threads=16, family=socket.AF_UNSPEC,
+                 socktype=socket.SOCK_STREAM):
+        """Resolves many names concurrently, filling the cache.
+        """
+        hosts = set(hosts)
+        if not hosts:
+            return
+        logging.debug("resolving %d names" % len(hosts))
+        executor = Executor(min(threads, len(hosts)), name='timyd-resolver')
+        try:
+            futures = [executor.submit(self._lookup, (host, family, socktype))
+                       for host in hosts]
+            for future in futures:
+                try:
+                    future.result()
+                except socket.error:
+                    pass # cached, or reported by the check
+        finally:
+            executor.shutdown()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
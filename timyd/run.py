@@ -1,11 +1,13 @@
 from optparse import OptionParser
 import logging
+import signal
 import string
 import sys
 
 from timyd import SiteManager, import_site
 from timyd.actions.text import TextOutput
 from timyd.console import colors
+from timyd.eventloop import EventLoop, Executor, Future
 
 
 class Runner(object):
@@ -22,6 +24,9 @@ class Runner(object):
         SiteManager.configure(**options)
         self.site = import_site(site)
 
+        self.jobs = max(1, options.get('jobs', 1))
+        self.processes = max(1, options.get('processes') or 1)
+
         if options['textoutput']:
             if options['colors'] == True:
                 colors.enable(True)
@@ -29,7 +34,9 @@ class Runner(object):
                 colors.enable(False)
             else: # options['colors'] is None
                 colors.auto()
-            self.site.add_action(TextOutput())
+            self.site.add_action(TextOutput(
+                    options.get('output_mode', 'text'),
+                    flush_every=options.get('flush_every')))
 
     def check_site(self):
         self.check_services(self.site.services.keys())
@@ -39,6 +46,19 @@ class Runner(object):
 
         self._checked_services = set()
         self._active_services = set()
+        # Nothing is probed yet in this run
+        with self.site.probes_lock:
+            self.site.probes.clear()
+
+        self._resolve_hostnames(service_names)
+
+        if self.processes > 1:
+            self._check_services_processes(service_names)
+            return
+
+        if self.jobs > 1:
+            self._check_services_parallel(service_names)
+            return
 
         for name in service_names:
             service = self.site.services[name]
@@ -60,12 +80,131 @@ class Runner(object):
         self._checked_services.add(service)
         self._active_services.remove(service)
 
+    def _resolve_hostnames(self, service_names):
+        """Resolves the hosts of the services to check, concurrently.
+        """
+        hostnames = set()
+        visited = set()
+        services = [self.site.services[name] for name in service_names]
+        while services:
+            service = services.pop()
+            if service not in visited:
+                visited.add(service)
+                hostnames.update(service.hostnames())
+                services.extend(self.site.get_dependencies(service))
+        SiteManager.resolver.prefetch(hostnames)
+
+    def _sort_services(self, service_names):
+        """Sorts the requested services and their dependencies topologically.
+
+        Dependencies always come before the services that depend on them.
+        """
+        order = []
+        visited = set()
+        active = set()
+
+        def visit(service):
+            if service in visited:
+                return
+            if service in active:
+                raise Exception(
+                        "Loop in service dependency graph! Services:\n%s" %
+                        string.join([s.name for s in active], ", "))
+            active.add(service)
+            for dep in self.site.get_dependencies(service):
+                visit(dep)
+            active.remove(service)
+            visited.add(service)
+            order.append(service)
+
+        for name in service_names:
+            visit(self.site.services[name])
+        return order
+
+    def _check_services_parallel(self, service_names):
+        """Runs the checks concurrently.
+
+        A service is dispatched as soon as all of its dependencies have been
+        checked, so the run takes about as long as the slowest chain of
+        dependencies instead of the sum of all the checks.
+
+        Checks that provide a check_task() run as coroutines on an event loop,
+        so any number of them can wait on the network at once; the others
+        are run on a pool of 'jobs' worker threads.
+        """
+        order = self._sort_services(service_names)
+
+        waiting = dict() # Service -> number of dependencies not yet checked
+        dependents = dict() # Service -> [Service]
+        for service in order:
+            deps = set(self.site.get_dependencies(service))
+            waiting[service] = len(deps)
+            for dep in deps:
+                dependents.setdefault(dep, []).append(service)
+
+        executor = Executor(self.jobs)
+        loop = EventLoop(executor)
+        all_done = Future()
+        state = {'running': 0, 'error': None}
+
+        def dispatch(service):
+            state['running'] += 1
+            task = service._do_check_task()
+            if task is not None:
+                future = loop.spawn(task)
+            else:
+                future = executor.submit(service._do_check)
+            future.add_done_callback(
+                    lambda f: loop.call_soon_threadsafe(finished, service, f))
+
+        def finished(service, future):
+            state['running'] -= 1
+            if future.exc_info() is not None:
+                # Stop dispatching, let the running checks finish
+                if state['error'] is None:
+                    state['error'] = future.exc_info()
+            else:
+                self._checked_services.add(service)
+                if state['error'] is None:
+                    for dependent in dependents.get(service, ()):
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            dispatch(dependent)
+            if state['running'] == 0:
+                all_done.set_result(None)
+
+        for service in order:
+            if waiting[service] == 0:
+                dispatch(service)
+        try:
+            if order:
+                loop.run_until_complete(all_done)
+        finally:
+            executor.shutdown()
+            loop.close()
+
+        error = state['error']
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def _check_services_processes(self, service_names):
+        """Runs the checks in several processes.
+
+        Services connected by dependencies are checked in the same process,
+        each with 'jobs' threads; see timyd.processes.
+        """
+        from timyd import processes
+
+        services = self._sort_services(service_names) # detects loops
+        self._checked_services = processes.check_services(
+                self, services, self.processes)
+
     def end_run(self):
         self.site.end_run()
 
 
-def main():
-    optparser = OptionParser()
+def _optparser(usage):
+    optparser = OptionParser(usage=usage)
     optparser.add_option(
             '-q', '--quiet',
             action='store_false', dest='textoutput',
@@ -86,10 +225,52 @@ def main():
             '--no-colors',
             action='store_false', dest='colors',
             help="don't use colored terminal output")
+    optparser.add_option(
+            '-j', '--jobs',
+            action='store', type='int', dest='jobs',
+            help="number of threads running checks concurrently; checks "
+                 "that support it also run on an event loop (default: 1)")
+    optparser.add_option(
+            '--processes',
+            action='store', type='int', dest='processes',
+            help="number of processes running checks; services connected "
+                 "by dependencies stay in the same process (default: 1)")
+    optparser.add_option(
+            '-o', '--output',
+            action='store', type='choice', dest='output_mode',
+            choices=TextOutput.MODES,
+            help="format of the output: text, table, or json (one object "
+                 "per line) (default: text)")
+    optparser.add_option(
+            '--flush-every',
+            action='store', type='int', dest='flush_every',
+            help="buffer the output, writing it every N events and at the "
+                 "end of each run (the json output is otherwise written at "
+                 "the end of each run, the text output as it happens); not "
+                 "with the table output, written at the end of each run")
+    optparser.add_option(
+            '--no-journal',
+            action='store_false', dest='journal',
+            help="don't keep a journal of the changes to recover the logs "
+                 "after a crash, nor sync them to disk")
     optparser.set_defaults(colors=None, verbosity=0, textoutput=True,
-                           logs='.timyd_logs')
-    (options, args) = optparser.parse_args()
+                           logs='.timyd_logs', jobs=1, processes=1,
+                           output_mode='text',
+                           flush_every=None, journal=True)
+    return optparser
+
+
+def _check_output_options(optparser, options):
+    # The columns of the table are sized for all the rows at once
+    if options['output_mode'] == 'table' and options['flush_every']:
+        optparser.error("--flush-every can't be used with the table output")
+
+
+def check_main(args):
+    optparser = _optparser("%prog [options] <site> [service [...]]")
+    (options, args) = optparser.parse_args(args)
     options = vars(options) # options is not a dict!?
+    _check_output_options(optparser, options)
 
     try:
         site = args.pop(0)
@@ -105,3 +286,228 @@ def main():
         runner.check_services(args)
 
     runner.end_run()
+
+
+def daemon_main(args):
+    from timyd.daemon import Scheduler
+
+    optparser = _optparser("%prog daemon [options] <site>")
+    optparser.add_option(
+            '-i', '--interval',
+            action='store', type='float', dest='interval',
+            help="default number of seconds between two checks of a "
+                 "service (default: 60)")
+    optparser.add_option(
+            '--jitter',
+            action='store', type='float', dest='jitter',
+            help="random variation of the intervals, as a fraction of the "
+                 "interval (default: 0.1)")
+    optparser.add_option(
+            '--log-pool',
+            action='store', type='int', dest='log_pool',
+            help="number of logs to keep open (default: 256)")
+    optparser.add_option(
+            '--flush-interval',
+            action='store', type='float', dest='flush_interval',
+            help="number of seconds between writes of the log summaries "
+                 "(default: 300)")
+    optparser.add_option(
+            '--dns-ttl',
+            action='store', type='float', dest='dns_ttl',
+            help="number of seconds resolved names are cached "
+                 "(default: 300)")
+    optparser.set_defaults(interval=60, jitter=0.1, log_pool=256,
+                           flush_interval=300, dns_ttl=300)
+    (options, args) = optparser.parse_args(args)
+    options = vars(options)
+    _check_output_options(optparser, options)
+
+    if len(args) != 1:
+        logging.critical("A single site must be specified")
+        sys.exit(2)
+
+    runner = Runner(args[0], **options)
+    scheduler = Scheduler(runner, options['interval'], options['jitter'])
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    scheduler.run_forever()
+
+
+def query_main(args):
+    import json
+    import time
+    from timyd import query
+
+    optparser = OptionParser(usage="""%prog query [options] <site> status [service [...]]
+       %prog query [options] <site> changes <property> [service [...]]
+       %prog query [options] <site> uptime [service [...]]""")
+    optparser.add_option(
+            '-l', '--logs',
+            action='store', dest='logs',
+            help="location of the service logs (default: .timyd_logs)")
+    optparser.add_option(
+            '-j', '--jobs',
+            action='store', type='int', dest='jobs',
+            help="number of logs read concurrently (default: 4)")
+    optparser.add_option(
+            '--since',
+            action='store', dest='since',
+            help="start of the period (Unix time, or YYYY-MM-DD[ HH:MM[:SS]] "
+                 "in UTC)")
+    optparser.add_option(
+            '--until',
+            action='store', dest='until',
+            help="end of the period (default: now)")
+    optparser.add_option(
+            '--days',
+            action='store', type='float', dest='days',
+            help="length of the period for uptime, if --since is not given "
+                 "(default: 30)")
+    optparser.add_option(
+            '--json',
+            action='store_true', dest='json',
+            help="print one JSON object per line")
+    optparser.set_defaults(logs='.timyd_logs', jobs=4, days=30, json=False)
+    (options, args) = optparser.parse_args(args)
+
+    if len(args) < 2 or args[1] not in ('status', 'changes', 'uptime'):
+        optparser.error("A site and a query must be specified")
+    site, command = args[:2]
+    args = args[2:]
+    try:
+        end = query.parse_time(options.until) if options.until else None
+        start = query.parse_time(options.since) if options.since else None
+        if command == 'changes':
+            if not args:
+                optparser.error("A property must be specified")
+            prop = args.pop(0)
+        logs = query.list_logs(options.logs, site, args)
+    except ValueError, e:
+        logging.critical(str(e))
+        sys.exit(1)
+
+    if command == 'status':
+        results = query.run_query(query.status, logs, options.jobs)
+        for service, result in results:
+            if result is None:
+                continue
+            status, t = result
+            if options.json:
+                print json.dumps({'service': service, 'status': status,
+                                  'since': t}, sort_keys=True)
+            else:
+                print "%s: %s since %s" % (service, status or 'OK',
+                                           query.format_time(t))
+    elif command == 'changes':
+        results = query.run_query(
+                lambda path: query.changes(path, prop, start, end),
+                logs, options.jobs)
+        for service, changes in results:
+            for t, value in changes:
+                if options.json:
+                    if isinstance(value, str):
+                        value = value.decode('utf-8', 'replace')
+                    print json.dumps({'service': service, 'property': prop,
+                                      'time': t, 'value': value},
+                                     sort_keys=True)
+                else:
+                    print "%s %s: %s: %s" % (query.format_time(t), service,
+                                             prop, value)
+    else: # uptime
+        if end is None:
+            end = int(time.time())
+        if start is None:
+            start = end - int(options.days * 86400)
+        results = query.run_query(
+                lambda path: query.uptime(path, start, end),
+                logs, options.jobs)
+        for service, ratio in results:
+            if options.json:
+                print json.dumps({'service': service, 'uptime': ratio,
+                                  'start': start, 'end': end},
+                                 sort_keys=True)
+            elif ratio is None:
+                print "%s: unknown" % service
+            else:
+                print "%s: %.3f%%" % (service, ratio * 100.0)
+    if len(results) < len(logs):
+        sys.exit(1)
+
+
+def compact_main(args):
+    import os
+    from timyd import query
+    from timyd.logged_properties import BinaryLog, InvalidFile, LockedFile
+
+    optparser = OptionParser(
+            usage="%prog compact [options] <site> [service [...]]")
+    optparser.add_option(
+            '-l', '--logs',
+            action='store', dest='logs',
+            help="location of the service logs (default: .timyd_logs)")
+    optparser.add_option(
+            '--keep-days',
+            action='store', type='float', dest='keep_days',
+            help="number of days for which all the changes are kept; older "
+                 "changes are only kept if they change the value "
+                 "(default: 30)")
+    optparser.add_option(
+            '--resolution',
+            action='store', type='int', dest='resolution',
+            help="only keep the last of the older changes in each interval "
+                 "of that many seconds, eg 3600 for hourly values")
+    optparser.set_defaults(logs='.timyd_logs', keep_days=30,
+                           resolution=None)
+    (options, args) = optparser.parse_args(args)
+
+    if not args:
+        optparser.error("A site must be specified")
+    try:
+        logs = query.list_logs(options.logs, args[0], args[1:])
+    except ValueError, e:
+        logging.critical(str(e))
+        sys.exit(1)
+
+    # The logs are rewritten: those opened by a running daemon are locked
+    errors = False
+    for service, path in logs:
+        size = os.path.getsize(path)
+        try:
+            log = BinaryLog(path, journal=True)
+        except InvalidFile:
+            logging.error("%s: invalid log, skipped" % service)
+            errors = True
+            continue
+        except LockedFile:
+            logging.error("%s: log in use, skipped" % service)
+            errors = True
+            continue
+        try:
+            before, after = log.compact(int(options.keep_days * 86400),
+                                        options.resolution)
+        except Exception:
+            logging.exception("%s: compaction failed, skipped" % service)
+            errors = True
+            # Releases the lock
+            try:
+                log.close()
+            except Exception:
+                logging.exception("%s: couldn't close the log" % service)
+            continue
+        print "%s: %d -> %d records, %d -> %d bytes" % (
+                service, before, after, size, os.path.getsize(path))
+    if errors:
+        sys.exit(1)
+
+
+_COMMANDS = {
+        'compact': compact_main,
+        'daemon': daemon_main,
+        'query': query_main}
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] in _COMMANDS:
+        _COMMANDS[args[0]](args[1:])
+    else:
+        check_main(args)